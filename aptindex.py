@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+#
+# aptindex.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import gzip
+import lzma
+import os
+import pickle
+
+from gi.repository import GLib
+
+from debug import *
+
+# Suffixes of the compressed variants of the Packages file that we know
+# how to read, in order of preference (smallest downloads first).
+PACKAGES_FILE_SUFFIXES = ['.xz', '.gz', '']
+
+# Map from the names of the checksum fields used in APT index files
+# to the name of the hashlib algorithms, strongest ones first.
+CHECKSUM_FIELDS = [('SHA256', 'sha256'), ('SHA1', 'sha1'), ('MD5sum', 'md5')]
+
+# Hashes trusted to tell whether a file matches its entry in an index file,
+# strongest ones first: MD5 is parsed, but never enough to validate a file.
+SECURE_HASHES = ['sha256', 'sha1']
+
+# Release files use a slightly different name for the MD5 field.
+_RELEASE_CHECKSUM_FIELDS = { 'SHA256': 'sha256', 'SHA1': 'sha1', 'MD5Sum': 'md5' }
+
+
+def _openIndexFile(path):
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rt', encoding='utf-8', errors='replace')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+
+def parseReleaseFile(path):
+    """
+    Parse the Release file pointed by path, returning a dictionary that maps the
+    path (relative to the distribution's directory) of every index file listed
+    in it to a dictionary with its size and the digests found, by hash name.
+    """
+    result = {}
+    hash_name = None
+    try:
+        with _openIndexFile(path) as release_file:
+            for line in release_file:
+                if not line.strip():
+                    continue
+
+                # Checksums are listed in multiline fields, where each
+                # continuation line is of the form " hash size path".
+                if line[0] in ' \t':
+                    if hash_name is None:
+                        continue
+                    fields = line.split()
+                    if len(fields) != 3:
+                        continue
+                    entry = result.setdefault(fields[2], { 'size': int(fields[1]) })
+                    entry[hash_name] = fields[0].lower()
+                    continue
+
+                field = line.split(':', 1)[0]
+                hash_name = _RELEASE_CHECKSUM_FIELDS.get(field)
+    except (OSError, ValueError, EOFError, lzma.LZMAError) as e:
+        raise GLib.GError("Error parsing Release file %s: %s" % (path, repr(e)))
+
+    return result
+
+
+def parsePackagesFile(path):
+    """
+    Parse the (maybe compressed) Packages file pointed by path, returning a
+    dictionary that maps the 'Filename' field of every stanza to a dictionary
+    with the size of that package and its digests, by hash name.
+    """
+    result = {}
+    try:
+        with _openIndexFile(path) as packages_file:
+            stanza = {}
+            for line in packages_file:
+                if not line.strip():
+                    _addPackageStanza(result, stanza)
+                    stanza = {}
+                    continue
+
+                # Multiline fields (e.g. descriptions) are not relevant here.
+                if line[0] in ' \t':
+                    continue
+
+                (field, sep, value) = line.partition(':')
+                if sep:
+                    stanza[field] = value.strip()
+            _addPackageStanza(result, stanza)
+    except (OSError, EOFError, lzma.LZMAError) as e:
+        raise GLib.GError("Error parsing Packages file %s: %s" % (path, repr(e)))
+
+    debugprint("Parsed %d package(s) from %s" % (len(result), os.path.basename(path)))
+    return result
+
+
+def _addPackageStanza(index, stanza):
+    if 'Filename' not in stanza:
+        return
+
+    entry = {}
+    try:
+        entry['size'] = int(stanza.get('Size', -1))
+    except ValueError:
+        entry['size'] = -1
+    for (field, hash_name) in CHECKSUM_FIELDS:
+        if field in stanza:
+            entry[hash_name] = stanza[field].lower()
+
+    index[stanza['Filename']] = entry
+
+
+def findEntry(index, filename):
+    """
+    Return the entry for filename (relative to the repository's root, exactly
+    as listed in the 'Filename' field) from a Packages index, or None if it
+    could not be found there.
+    """
+    return index.get(filename)
+
+
+def matchesEntry(entry, size, hashes, hash_names=SECURE_HASHES):
+    """
+    Return True if a file with the given size and digests (a dictionary
+    indexed by hash name) matches the entry of an index, or False otherwise.
+
+    Only the strongest hash from hash_names present in both sides is compared,
+    so the file never matches if none of them is available (e.g. only MD5),
+    and the size is only checked if known (i.e. not None nor negative).
+    """
+    if size is not None and entry.get('size', -1) >= 0 and size != entry['size']:
+        return False
+
+    for hash_name in hash_names:
+        if hash_name in entry and hash_name in hashes:
+            return entry[hash_name] == hashes[hash_name]
+    return False
+
+
+def saveIndex(index, path):
+    """
+    Persist a parsed index in a compact binary form to the file pointed by path.
+    """
+    try:
+        with open(path + '.tmp', 'wb') as index_file:
+            pickle.dump(index, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+    except OSError as e:
+        raise GLib.GError("Error saving index to %s: %s" % (path, repr(e)))
+
+
+def loadIndex(path):
+    """
+    Load an index previously saved with saveIndex, or None if not possible.
+    """
+    try:
+        with open(path, 'rb') as index_file:
+            return pickle.load(index_file)
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        debugprint("Could not load index from %s: %s" % (path, repr(e)))
+        return None
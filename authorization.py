@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+#
+# authorization.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import config
+import stats
+import time
+
+from gi.repository import GLib
+
+from debug import *
+
+DBUS_BUS_NAME = 'org.freedesktop.DBus'
+DBUS_PATH = '/org/freedesktop/DBus'
+DBUS_IFACE = 'org.freedesktop.DBus'
+
+
+class Authorizer:
+    """
+    Class checking PolicyKit authorizations asynchronously from the main loop,
+    keeping the positive results for every sender (unique bus name) and action
+    during ttl seconds, or until the sender disconnects from the bus.
+
+    Concurrent checks for the same sender and action share a single request
+    to polkitd, while negative results are never cached, so that callers can
+    be authorized right after their previous attempt failed.
+    """
+    def __init__(self, bus, ttl=config.AUTHORIZATION_CACHE_TTL):
+        self._ttl = ttl
+        self._authority = None
+        self._authorized = {}
+        self._pending = {}
+
+        # Unique names are never reused, but entries for senders that are
+        # gone would stay in the cache (until expired) if not removed.
+        bus.add_signal_receiver(self._nameOwnerChangedCb,
+                                signal_name='NameOwnerChanged',
+                                dbus_interface=DBUS_IFACE,
+                                bus_name=DBUS_BUS_NAME,
+                                path=DBUS_PATH)
+
+    def check(self, sender, action_id, callback):
+        """
+        Check whether sender is authorized to perform action_id, and call
+        callback(authorized, error) from the main loop once known, where error
+        is a GLib.GError if the authorization could not be checked, or None.
+
+        Must be called from the thread running the main loop.
+        """
+        key = (sender, action_id)
+        expiration = self._authorized.get(key)
+        if expiration is not None and expiration > time.monotonic():
+            debugprint("Action %s authorized for %s (cached)" % (action_id, sender))
+            stats.getDefault().count('authorizations_cached')
+            callback(True, None)
+            return
+        self._authorized.pop(key, None)
+
+        if key in self._pending:
+            self._pending[key].append(callback)
+            return
+        self._pending[key] = [callback]
+
+        debugprint("Checking authorization for action %s and sender %s" % (action_id, sender))
+        try:
+            # Lazy initialization of the Polkit authority object, loading
+            # its typelib only when the first authorization is checked.
+            from gi.repository import Polkit
+            if self._authority is None:
+                self._authority = Polkit.Authority.get_sync(None)
+
+            subject = Polkit.SystemBusName.new(sender)
+            self._authority.check_authorization(subject, action_id, None,
+                                                Polkit.CheckAuthorizationFlags.NONE,
+                                                None, self._checkAuthorizationCb,
+                                                (key, time.monotonic()))
+        except GLib.GError as e:
+            self._finish(key, False, e)
+
+    def _checkAuthorizationCb(self, authority, result, user_data):
+        (key, start) = user_data
+        stats.getDefault().record('authorization', time.monotonic() - start)
+        try:
+            auth_result = authority.check_authorization_finish(result)
+        except GLib.GError as e:
+            self._finish(key, False, e)
+            return
+
+        authorized = auth_result is not None and auth_result.get_is_authorized()
+        debugprint("Action %s is %sAUTHORIZED for %s" % (key[1], "" if authorized else "NOT ", key[0]))
+        if authorized:
+            self._authorized[key] = time.monotonic() + self._ttl
+        self._finish(key, authorized, None)
+
+    def _finish(self, key, authorized, error):
+        for callback in self._pending.pop(key, []):
+            callback(authorized, error)
+
+    def _nameOwnerChangedCb(self, name, old_owner, new_owner):
+        if new_owner or not name.startswith(':'):
+            return
+
+        for key in [key for key in self._authorized if key[0] == name]:
+            debugprint("Forgetting authorization of %s for %s" % (key[1], name))
+            del self._authorized[key]
@@ -0,0 +1,442 @@
+#!/usr/bin/python3
+#
+# run-benchmarks.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Offline benchmarks for eos-config-printer.
+
+Creates a throwaway GPG key and a signed APT repository with synthetic driver
+packages, serves it from a local HTTP server, and measures the latency of
+installing and validating those packages, the throughput when installing
+several of them at the same time, and the peak RSS of the process.
+
+Everything (including the paths from config.py) is redirected to a temporary
+directory, so this can be run by a regular user, from a built source tree:
+
+  ./autogen.sh && make && ./benchmarks/run-benchmarks.py --output results.json
+"""
+
+import argparse
+import concurrent.futures
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import lzma
+import os
+import resource
+import shutil
+import socketserver
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+SRCDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRCDIR)
+
+import config
+
+DIST_NAME = 'bench'
+COMPONENT_DIR = 'main/binary-all'
+KEY_EMAIL = 'benchmarks@eos-config-printer.invalid'
+
+
+class _QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # Keep-alive connections, like most APT repositories out there.
+    protocol_version = 'HTTP/1.1'
+    root_dir = None
+
+    def translate_path(self, path):
+        path = super().translate_path(path)
+        return os.path.join(self.root_dir, os.path.relpath(path, os.getcwd()))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class LocalRepository:
+    """
+    Signed APT repository with synthetic driver packages, stored under
+    root_dir and served over HTTP from a random port of localhost.
+    """
+    def __init__(self, root_dir, gnupg_home):
+        self._root_dir = root_dir
+        self._gnupg_home = gnupg_home
+        self._dist_dir = os.path.join(root_dir, 'dists', DIST_NAME)
+        self._packages_dir = os.path.join(self._dist_dir, COMPONENT_DIR)
+        self._packages = []
+        self._server = None
+        self.fingerprint = None
+        self.base_uri = None
+
+    def createKey(self):
+        import gnupg
+        gpg = gnupg.GPG(gnupghome=self._gnupg_home)
+        key_input = gpg.gen_key_input(key_type='RSA', key_length=2048,
+                                      name_real='eos-config-printer benchmarks',
+                                      name_email=KEY_EMAIL, no_protection=True)
+        self.fingerprint = str(gpg.gen_key(key_input))
+        if not self.fingerprint:
+            raise RuntimeError("Could not generate a GPG key for the benchmarks")
+
+        # Make the key trusted by the service, without a key server.
+        os.makedirs(os.path.dirname(config.TRUSTED_KEYRING_FILE), exist_ok=True)
+        keyring = gnupg.GPG(keyring=config.TRUSTED_KEYRING_FILE)
+        if not keyring.import_keys(gpg.export_keys(self.fingerprint)).count:
+            raise RuntimeError("Could not import the GPG key for the benchmarks")
+
+    def addPackage(self, name, num_ppds, ppd_size, version='1.0'):
+        """
+        Create a driver package with num_ppds PPD files under /opt/<name>,
+        returning the URI it will be served from.
+        """
+        os.makedirs(self._packages_dir, exist_ok=True)
+        filename = '%s_%s_all.deb' % (name, version)
+        path = os.path.join(self._packages_dir, filename)
+        with open(path, 'wb') as deb_file:
+            deb_file.write(_buildDebPackage(name, version, num_ppds, ppd_size))
+
+        self._packages.append((name, version, path))
+        return '%s/dists/%s/%s/%s' % (self.base_uri, DIST_NAME, COMPONENT_DIR, filename)
+
+    def getPackagePath(self, index):
+        return self._packages[index][2]
+
+    def publish(self):
+        """
+        (Re)generate the Packages and Release files, and sign the latter.
+        """
+        import gnupg
+
+        stanzas = []
+        for (name, version, path) in self._packages:
+            with open(path, 'rb') as deb_file:
+                contents = deb_file.read()
+            stanzas.append('\n'.join(['Package: %s' % name,
+                                      'Version: %s' % version,
+                                      'Architecture: all',
+                                      'Filename: %s' % os.path.relpath(path, self._root_dir),
+                                      'Size: %d' % len(contents),
+                                      'MD5sum: %s' % hashlib.md5(contents).hexdigest(),
+                                      'SHA1: %s' % hashlib.sha1(contents).hexdigest(),
+                                      'SHA256: %s' % hashlib.sha256(contents).hexdigest()]))
+        packages = ('\n\n'.join(stanzas) + '\n').encode('utf-8')
+
+        indexes = { 'Packages': packages,
+                    'Packages.gz': gzip.compress(packages),
+                    'Packages.xz': lzma.compress(packages) }
+        for (name, contents) in indexes.items():
+            with open(os.path.join(self._packages_dir, name), 'wb') as index_file:
+                index_file.write(contents)
+
+        release = ['Origin: eos-config-printer benchmarks',
+                   'Suite: %s' % DIST_NAME,
+                   'Date: %s' % time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime())]
+        for (field, hash_name) in [('MD5Sum', 'md5'), ('SHA1', 'sha1'), ('SHA256', 'sha256')]:
+            release.append('%s:' % field)
+            for (name, contents) in sorted(indexes.items()):
+                release.append(' %s %d %s/%s' % (hashlib.new(hash_name, contents).hexdigest(),
+                                                 len(contents), COMPONENT_DIR, name))
+        release_path = os.path.join(self._dist_dir, 'Release')
+        with open(release_path, 'w') as release_file:
+            release_file.write('\n'.join(release) + '\n')
+
+        gpg = gnupg.GPG(gnupghome=self._gnupg_home)
+        with open(release_path, 'rb') as release_file:
+            signature = gpg.sign_file(release_file, keyid=self.fingerprint, detach=True,
+                                      output=release_path + '.gpg')
+        if not signature:
+            raise RuntimeError("Could not sign the Release file: %s" % signature.stderr)
+
+    def startServer(self):
+        _QuietHTTPRequestHandler.root_dir = self._root_dir
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _QuietHTTPRequestHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.base_uri = 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def stopServer(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _addTarMember(tarball, name, contents=None, mode=0o644, mtime=None):
+    info = tarfile.TarInfo(name)
+    info.mtime = mtime if mtime is not None else int(time.time())
+    info.uid = info.gid = 0
+    info.uname = info.gname = 'root'
+    if contents is None:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tarball.addfile(info)
+    else:
+        info.mode = mode
+        info.size = len(contents)
+        tarball.addfile(info, io.BytesIO(contents))
+
+
+def _buildTarball(members, compression):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:' + compression) as tarball:
+        for member in members:
+            _addTarMember(tarball, *member)
+    return buf.getvalue()
+
+
+def _buildPPDFile(name, index, size):
+    header = ('*PPD-Adobe: "4.3"\n'
+              '*Manufacturer: "Benchmarks"\n'
+              '*ModelName: "%s model %d"\n'
+              '*NickName: "%s model %d"\n' % (name, index, name, index)).encode('ascii')
+    filler = b'*% Synthetic PPD file used for benchmarking purposes only\n'
+    return (header + filler * (max(size - len(header), 0) // len(filler) + 1))[:max(size, len(header))]
+
+
+def _buildDebPackage(name, version, num_ppds, ppd_size):
+    data_members = [('./',), ('./opt/',), ('./opt/%s/' % name,), ('./opt/%s/ppd/' % name,)]
+    md5sums = []
+    for index in range(num_ppds):
+        path = 'opt/%s/ppd/%s-%04d.ppd' % (name, name, index)
+        contents = _buildPPDFile(name, index, ppd_size)
+        data_members.append(('./' + path, contents))
+        md5sums.append('%s  %s' % (hashlib.md5(contents).hexdigest(), path))
+
+    control = ('Package: %s\nVersion: %s\nArchitecture: all\n'
+               'Maintainer: Benchmarks <%s>\nDescription: Synthetic driver\n'
+               % (name, version, KEY_EMAIL)).encode('utf-8')
+    control_members = [('./',), ('./control', control),
+                       ('./md5sums', ('\n'.join(md5sums) + '\n').encode('utf-8'))]
+
+    members = [('debian-binary', b'2.0\n'),
+               ('control.tar.gz', _buildTarball(control_members, 'gz')),
+               ('data.tar.xz', _buildTarball(data_members, 'xz'))]
+
+    deb = io.BytesIO()
+    deb.write(b'!<arch>\n')
+    for (member_name, contents) in members:
+        header = '%-16s%-12d%-6d%-6d%-8s%-10d`\n' % (member_name, int(time.time()),
+                                                      0, 0, '100644', len(contents))
+        deb.write(header.encode('ascii'))
+        deb.write(contents)
+        if len(contents) % 2:
+            deb.write(b'\n')
+    return deb.getvalue()
+
+
+def _redirectConfigPaths(work_dir):
+    # Every absolute path in config.py is moved under the work directory,
+    # which must be done before importing any other module from the service.
+    root_dir = os.path.join(work_dir, 'root')
+    for name in dir(config):
+        value = getattr(config, name)
+        if name.isupper() and isinstance(value, str) and os.path.isabs(value):
+            setattr(config, name, os.path.join(root_dir, value.lstrip('/')))
+    config.PROMETHEUS_TEXTFILE_ENABLED = False
+
+    # Keep GPG away from the keyrings of the user running the benchmarks.
+    os.environ['GNUPGHOME'] = os.path.join(work_dir, 'gnupg-service')
+    os.makedirs(os.environ['GNUPGHOME'], mode=0o700, exist_ok=True)
+
+
+def _peakRSS():
+    # Reported in kilobytes on Linux. This is the peak for the whole process,
+    # which never decreases, so it can not be attributed to a single benchmark.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _summarize(latencies):
+    latencies = sorted(latencies)
+    return { 'samples': len(latencies),
+             'mean': statistics.mean(latencies),
+             'median': statistics.median(latencies),
+             'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+             'min': latencies[0],
+             'max': latencies[-1] }
+
+
+def _timed(func, *args):
+    start = time.monotonic()
+    func(*args)
+    return time.monotonic() - start
+
+
+def _forgetCaches():
+    import downloadcache
+    import pkgstore
+    import pkgvalidator
+    import registry
+
+    # Start from a cold state: nothing installed, downloaded nor verified.
+    for path in [config.DRIVERS_DIR, config.CUPS_VISIBLE_PPD_DIR, config.DOWNLOAD_CACHE_DIR,
+                 config.METADATA_CACHE_DIR, config.PACKAGE_STORE_DIR,
+                 os.path.dirname(config.REGISTRY_FILE)]:
+        for entry in os.listdir(path) if os.path.isdir(path) else []:
+            if os.path.join(path, entry) == config.TRUSTED_KEYRING_FILE:
+                continue
+            entry_path = os.path.join(path, entry)
+            if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+                shutil.rmtree(entry_path)
+            else:
+                os.remove(entry_path)
+
+    downloadcache._default_cache = None
+    pkgstore._default_store = None
+    registry._default_registry = None
+    pkgvalidator._metadata_cache = pkgvalidator.RepositoryMetadataCache(config.METADATA_CACHE_DIR)
+
+
+def runBenchmarks(options, work_dir):
+    _redirectConfigPaths(work_dir)
+
+    # Modules from the service can only be imported from this point on.
+    import pkgvalidator
+    import printerdriver
+    import stats
+
+    gnupg_home = os.path.join(work_dir, 'gnupg-repository')
+    os.makedirs(gnupg_home, mode=0o700)
+    repository = LocalRepository(os.path.join(work_dir, 'repository'), gnupg_home)
+    repository.startServer()
+    try:
+        repository.createKey()
+        total = options.iterations + options.drivers
+        uris = [repository.addPackage('bench-driver-%03d' % index, options.ppds, options.ppd_size)
+                for index in range(total)]
+        repository.publish()
+
+        install = lambda uri: printerdriver.PrinterDriverOpenPrinting({ 'uri': uri,
+                                                                  'fingerprint': repository.fingerprint }).install()
+        results = {}
+
+        # Installing a package not seen before, from scratch every time.
+        latencies = []
+        for uri in uris[:options.iterations]:
+            _forgetCaches()
+            latencies.append(_timed(install, uri))
+        results['install_cold'] = _summarize(latencies)
+
+        # Installing it again, once the repository metadata is cached.
+        _forgetCaches()
+        install(uris[0])
+        results['install_repeated'] = _summarize([_timed(install, uris[0])
+                                                  for i in range(options.iterations)])
+
+        # Installing a package prefetched already, from scratch every time.
+        latencies = []
+        for uri in uris[:options.iterations]:
+            _forgetCaches()
+            printerdriver.PrinterDriverOpenPrinting({ 'uri': uri,
+                                                      'fingerprint': repository.fingerprint }).prefetch()
+            latencies.append(_timed(install, uri))
+        results['install_prefetched'] = _summarize(latencies)
+
+        # Validating an already downloaded package against the repository.
+        deb_path = os.path.join(work_dir, 'package.deb')
+        shutil.copyfile(repository.getPackagePath(0), deb_path)
+        latencies = []
+        for cold in [True] + [False] * (options.iterations - 1):
+            if cold:
+                _forgetCaches()
+            validator = pkgvalidator.PackageValidator(uris[0], repository.fingerprint)
+            latencies.append(_timed(validator.run, deb_path))
+        results['validate'] = _summarize(latencies)
+
+        # Installing several different packages at the same time.
+        _forgetCaches()
+        concurrent_uris = uris[options.iterations:]
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+            latencies = list(executor.map(lambda uri: _timed(install, uri), concurrent_uris))
+        elapsed = time.monotonic() - start
+        results['install_concurrent'] = _summarize(latencies)
+        results['install_concurrent']['elapsed'] = elapsed
+        results['install_concurrent']['drivers_per_second'] = len(concurrent_uris) / elapsed
+    finally:
+        repository.stopServer()
+
+    service_stats = stats.getDefault()
+    return { 'results': results,
+             'peak_rss_kib': _peakRSS(),
+             'statistics': { 'histograms': service_stats.getHistograms(),
+                             'counters': service_stats.getCounters() } }
+
+
+def _getRevision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=SRCDIR,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run offline benchmarks for eos-config-printer")
+    parser.add_argument('--ppds', type=int, default=50,
+                        help="number of PPD files in every package (default: %(default)s)")
+    parser.add_argument('--ppd-size', type=int, default=32 * 1024,
+                        help="size in bytes of every PPD file (default: %(default)s)")
+    parser.add_argument('--iterations', type=int, default=5,
+                        help="number of samples for every sequential benchmark (default: %(default)s)")
+    parser.add_argument('--drivers', type=int, default=8,
+                        help="number of packages installed at the same time (default: %(default)s)")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="number of threads installing packages at the same time (default: %(default)s)")
+    parser.add_argument('--output', default='-',
+                        help="file to write the results to, as JSON (default: standard output)")
+    parser.add_argument('--keep', action='store_true',
+                        help="do not remove the temporary directory when finished")
+    parser.add_argument('--debug', action='store_true',
+                        help="print debugging messages from the service")
+    options = parser.parse_args()
+    if options.iterations < 1 or options.drivers < 1:
+        parser.error("--iterations and --drivers must be greater than 0")
+
+    if options.debug:
+        import debug
+        debug.set_debugging(True)
+
+    work_dir = tempfile.mkdtemp(prefix='eos-config-printer-benchmarks-')
+    try:
+        report = runBenchmarks(options, work_dir)
+    finally:
+        if options.keep:
+            print("Temporary files kept in %s" % work_dir, file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report['revision'] = _getRevision()
+    report['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    report['parameters'] = vars(options)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output == '-':
+        print(output)
+    else:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output + '\n')
@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+#
+# debextract.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import hashlib
+import os
+import stat
+import tarfile
+
+from gi.repository import GLib
+
+from debug import *
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+
+# Size of the chunks copied at once from the package to the extracted files.
+EXTRACT_CHUNK_SIZE = 64 * 1024
+
+
+class _ArMemberReader:
+    """
+    File-like object giving read-only, sequential access to the contents of
+    a single member of an ar archive, without reading past its end.
+    """
+    def __init__(self, file_obj, size):
+        self._file_obj = file_obj
+        self._remaining = size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file_obj.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def remaining(self):
+        return self._remaining
+
+
+class ExtractionResult:
+    """
+    Class describing the result of extracting a debian package: the relative
+    paths of the files extracted, the paths of the members skipped because
+    they were not under any of the requested prefixes, the number of files
+    (and bytes) written, and reused from a previous version instead, and the
+    relative paths of the PPD files found, and of the directories with them,
+    along with the SHA256 digests of those PPD files written, by relative path.
+    """
+    def __init__(self):
+        self.extracted = []
+        self.skipped = []
+        self.ppd_files = []
+        self.ppd_dirs = []
+        self.ppd_digests = {}
+        self.linked_files = 0
+        self.linked_bytes = 0
+        self.written_files = 0
+        self.written_bytes = 0
+
+
+def _iterArMembers(file_obj):
+    if file_obj.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise GLib.GError("Not a debian package (bad ar header)")
+
+    while True:
+        header = file_obj.read(AR_HEADER_SIZE)
+        if not header:
+            return
+        if len(header) != AR_HEADER_SIZE or header[58:60] != b'`\n':
+            raise GLib.GError("Corrupted debian package (bad member header)")
+
+        name = header[0:16].decode('ascii', 'replace').strip().rstrip('/')
+        try:
+            size = int(header[48:58].decode('ascii').strip())
+        except ValueError:
+            raise GLib.GError("Corrupted debian package (bad member size)")
+
+        reader = _ArMemberReader(file_obj, size)
+        yield (name, reader)
+
+        # Skip whatever was not read from the member, plus the padding
+        # byte used by ar to keep members aligned to even offsets.
+        file_obj.seek(reader.remaining() + (size % 2), os.SEEK_CUR)
+
+
+def _openTarball(name, reader):
+    if name.endswith('.gz'):
+        return tarfile.open(fileobj=reader, mode='r|gz')
+    if name.endswith('.xz'):
+        return tarfile.open(fileobj=reader, mode='r|xz')
+    if name.endswith('.bz2'):
+        return tarfile.open(fileobj=reader, mode='r|bz2')
+    if name.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise GLib.GError("Extracting zstd compressed packages requires the "
+                              "python3-zstandard module")
+        stream = zstandard.ZstdDecompressor().stream_reader(reader)
+        return tarfile.open(fileobj=stream, mode='r|')
+    if name.endswith('.tar'):
+        return tarfile.open(fileobj=reader, mode='r|')
+
+    raise GLib.GError("Unsupported member in debian package: %s" % name)
+
+
+def _readMD5Sums(tarball):
+    # The md5sums control file lists the digest of every file in the
+    # package, with lines of the form "<md5sum>  <path without ./>".
+    for member in tarball:
+        if _normalizeMemberName(member.name) != 'md5sums' or not member.isreg():
+            continue
+
+        result = {}
+        for line in tarball.extractfile(member).read().decode('utf-8', 'replace').splitlines():
+            (md5sum, sep, path) = line.partition(' ')
+            if sep:
+                result[path.strip()] = md5sum.lower()
+        return result
+    return {}
+
+
+def _fileMD5Sum(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file_obj:
+        while True:
+            chunk = file_obj.read(EXTRACT_CHUNK_SIZE)
+            if not chunk:
+                break
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def isPPDFile(path):
+    """
+    Return True if path looks like a (maybe compressed) PPD file.
+    """
+    path_l = path.lower()
+    return path_l.endswith('.ppd') or path_l.endswith('.ppd.gz')
+
+
+def _normalizeMemberName(name):
+    # Members of the data tarball are usually named like './opt/foo/bar'.
+    while name.startswith('./'):
+        name = name[2:]
+    name = name.rstrip('/')
+    if name == '.':
+        return ''
+
+    if name.startswith('/') or '..' in name.split('/'):
+        raise GLib.GError("Refusing to extract unsafe path from package: %s" % name)
+    return name
+
+
+def _hasPrefix(name, prefixes):
+    for prefix in prefixes:
+        if name == prefix or name.startswith(prefix + '/'):
+            return True
+    return False
+
+
+class DebExtractor:
+    """
+    Class implementing an in-process extractor for debian packages, which reads
+    the package as a stream (ar archive, then its data tarball) and writes the
+    members found under the given prefixes straight to the destination directory.
+
+    Members with absolute paths or going up in the hierarchy are rejected, as well
+    as those that would be written through a symbolic link or hard link pointing
+    outside of the destination directory. Symbolic links named like the prefixes,
+    or right under them, are skipped.
+
+    If reference_dirs is passed, mapping prefixes to the directories where a
+    previous version of the package was installed (e.g. { 'opt': '/opt' }),
+    regular files whose size, modification time and MD5 digest (which must be
+    listed in the package) are the same than in the previous version, and that
+    are really inside of those directories (not reached through symbolic links),
+    are hard linked from there instead of written again, so only the
+    differences are written.
+
+    If a utils.ProgressMonitor is passed via monitor, the progress is reported
+    as the number of bytes read from the package, and the extraction is stopped
+    (raising a GLib.GError) as soon as it gets cancelled.
+    """
+    def __init__(self, deb_path, dest_dir, prefixes=('opt',), reference_dirs=None,
+                 monitor=None):
+        self._deb_path = deb_path
+        self._dest_dir = dest_dir
+        self._prefixes = prefixes
+        self._reference_dirs = reference_dirs or {}
+        self._monitor = monitor
+        self._md5sums = {}
+        self._deb_file = None
+
+    def extract(self):
+        """
+        Extract the package, returning an ExtractionResult object.
+        """
+        debugprint("Extracting contents for file %s into %s..." % (self._deb_path,
+                                                                   self._dest_dir))
+        result = ExtractionResult()
+        try:
+            os.makedirs(self._dest_dir, exist_ok=True)
+            self._dest_dir = os.path.realpath(self._dest_dir)
+            with open(self._deb_path, 'rb') as deb_file:
+                self._deb_file = deb_file
+                for (name, reader) in _iterArMembers(deb_file):
+                    if name.startswith('control.tar') and self._reference_dirs:
+                        with _openTarball(name, reader) as tarball:
+                            self._md5sums = _readMD5Sums(tarball)
+                    elif name.startswith('data.tar'):
+                        with _openTarball(name, reader) as tarball:
+                            self._extractTarball(tarball, result)
+                        return result
+        except (OSError, EOFError, tarfile.TarError) as e:
+            raise GLib.GError("Error extracting the contents of %s: %s" % (self._deb_path, repr(e)))
+
+        raise GLib.GError("No data member found in debian package %s" % self._deb_path)
+
+    def _extractTarball(self, tarball, result):
+        directories = []
+        deb_size = os.fstat(self._deb_file.fileno()).st_size
+        for member in tarball:
+            if self._monitor is not None:
+                self._monitor.update(self._deb_file.tell(), deb_size)
+
+            name = _normalizeMemberName(member.name)
+            if not name:
+                continue
+            if not _hasPrefix(name, self._prefixes):
+                result.skipped.append(name)
+                continue
+
+            # Prefixes and their direct children are moved into place as a whole
+            # once extracted, so these can never be symbolic links, or their
+            # targets would be moved (instead of the links) by the caller.
+            if member.issym() and (name in self._prefixes or
+                                   os.path.dirname(name) in self._prefixes):
+                debugprint("Skipping symbolic link %s" % name)
+                continue
+
+            dest_path = self._getDestPath(name)
+            if member.isdir():
+                os.makedirs(dest_path, exist_ok=True)
+                self._checkInsideDestDir(dest_path, name)
+                directories.append((dest_path, member))
+                continue
+
+            self._removeExisting(dest_path)
+            if member.isreg() and self._linkFromReference(name, member, dest_path):
+                result.linked_files += 1
+                result.linked_bytes += member.size
+            elif member.isreg():
+                # Digests of PPD files are computed while writing them, so
+                # that identical ones can be found without reading them again.
+                hash_obj = hashlib.sha256() if isPPDFile(name) else None
+                self._extractFile(tarball, member, dest_path, hash_obj)
+                if hash_obj is not None:
+                    result.ppd_digests[name] = hash_obj.hexdigest()
+                result.written_files += 1
+                result.written_bytes += member.size
+            elif member.issym():
+                os.symlink(member.linkname, dest_path)
+            elif member.islnk():
+                link_name = _normalizeMemberName(member.linkname)
+                os.link(self._getDestPath(link_name), dest_path)
+            else:
+                debugprint("Skipping special file %s" % name)
+                continue
+
+            result.extracted.append(name)
+            if isPPDFile(name):
+                debugprint("PPD file found!: %s" % name)
+                result.ppd_files.append(name)
+                ppd_dir = os.path.dirname(name)
+                if ppd_dir not in result.ppd_dirs:
+                    result.ppd_dirs.append(ppd_dir)
+
+        # Permissions and times of directories are set at the end, as
+        # they change while extracting the files contained in them.
+        for (dest_path, member) in reversed(directories):
+            os.chmod(dest_path, member.mode & 0o7777)
+            os.utime(dest_path, (member.mtime, member.mtime))
+
+    def _extractFile(self, tarball, member, dest_path, hash_obj=None):
+        src_obj = tarball.extractfile(member)
+        with open(dest_path, 'wb') as dest_obj:
+            while True:
+                if self._monitor is not None:
+                    self._monitor.checkCancelled()
+                chunk = src_obj.read(EXTRACT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if hash_obj is not None:
+                    hash_obj.update(chunk)
+                dest_obj.write(chunk)
+        os.chmod(dest_path, member.mode & 0o7777)
+        os.utime(dest_path, (member.mtime, member.mtime))
+
+    def _linkFromReference(self, name, member, dest_path):
+        # Files are only reused if their digest is listed in the package, as
+        # their size, modification time and permissions are not enough.
+        md5sum = self._md5sums.get(name)
+        reference_path = self._getReferencePath(name)
+        if md5sum is None or reference_path is None:
+            return False
+
+        try:
+            st = os.lstat(reference_path)
+            if not stat.S_ISREG(st.st_mode) or \
+               st.st_size != member.size or int(st.st_mtime) != int(member.mtime) or \
+               (st.st_mode & 0o7777) != (member.mode & 0o7777):
+                return False
+
+            if _fileMD5Sum(reference_path) != md5sum:
+                return False
+
+            os.link(reference_path, dest_path)
+        except OSError as e:
+            debugprint("Could not reuse %s: %s" % (reference_path, repr(e)))
+            return False
+
+        return True
+
+    def _getReferencePath(self, name):
+        for (prefix, reference_dir) in self._reference_dirs.items():
+            if not name.startswith(prefix + '/'):
+                continue
+
+            # Symbolic links in the deployed tree (e.g. from other packages)
+            # must never make us reuse files from outside of it.
+            reference_dir = os.path.realpath(reference_dir)
+            reference_path = os.path.join(reference_dir, name[len(prefix) + 1:])
+            if os.path.realpath(reference_path) != reference_path or \
+               not reference_path.startswith(reference_dir + os.sep):
+                return None
+            return reference_path
+        return None
+
+    def _getDestPath(self, name):
+        dest_path = os.path.join(self._dest_dir, name)
+
+        # Make sure that no symbolic link extracted before makes us write
+        # the file (or create the directory) outside of the destination,
+        # checking the closest existing ancestor before creating the rest.
+        parent_dir = os.path.dirname(dest_path)
+        ancestor = parent_dir
+        while not os.path.lexists(ancestor):
+            ancestor = os.path.dirname(ancestor)
+        self._checkInsideDestDir(ancestor, name)
+
+        os.makedirs(parent_dir, exist_ok=True)
+        return dest_path
+
+    def _checkInsideDestDir(self, path, name):
+        real_path = os.path.realpath(path)
+        if real_path != self._dest_dir and \
+           not real_path.startswith(self._dest_dir + os.sep):
+            raise GLib.GError("Refusing to extract path outside the destination: %s" % name)
+
+    def _removeExisting(self, dest_path):
+        if os.path.lexists(dest_path) and not os.path.isdir(dest_path):
+            os.unlink(dest_path)
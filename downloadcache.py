@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+#
+# downloadcache.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import aptindex
+import config
+import json
+import os
+import shutil
+import threading
+import time
+import utils
+
+from gi.repository import GLib
+
+from debug import *
+
+
+class DownloadCache:
+    """
+    Class implementing a persistent, content-addressed cache of downloaded
+    files, indexed by URI and revalidated against the server by means of
+    conditional requests (ETag and Last-Modified headers).
+
+    Files are stored only once under the 'objects' subdirectory, named after
+    the SHA256 digest of their contents, and the least recently used ones are
+    evicted whenever the total size of the cache goes over max_size bytes.
+    """
+    def __init__(self, cache_dir=config.DOWNLOAD_CACHE_DIR,
+                 max_size=config.DOWNLOAD_CACHE_MAX_SIZE):
+        self._cache_dir = cache_dir
+        self._objects_dir = os.path.join(cache_dir, 'objects')
+        self._index_path = os.path.join(cache_dir, 'index.json')
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._index = None
+
+    def fetch(self, uri, dest_dir=config.TEMPORARY_DIR, monitor=None, expected=None,
+              mirrors=None):
+        """
+        Make the file pointed by uri available under dest_dir, reusing the
+        cached copy if the server reports it has not been modified. The
+        progress is reported to the utils.ProgressMonitor passed, if any.
+
+        If the size and digests of the file are known, they can be passed as a
+        dictionary via expected, so that cached copies not matching them are
+        not reused, and neither are the interrupted downloads being resumed.
+
+        If a utils.MirrorSet is passed via mirrors, the file might be downloaded
+        from any of the mirrors of its archive, and it is cached apart from the
+        copies downloaded from uri, as it must be validated before being used.
+
+        Return a DownloadedFile object for the file placed under dest_dir,
+        which can be freely removed by the caller once no longer needed.
+        """
+        self._ensureCacheDir()
+        key = utils.getDownloadKey(uri, mirrors)
+
+        with self._lock:
+            entry = self._getIndex().get(key)
+            if entry and not os.path.exists(self._objectPath(entry['sha256'])):
+                entry = None
+            if entry and expected is not None and \
+               not aptindex.matchesEntry(expected, entry['size'], entry['hashes']):
+                entry = None
+
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        # Download straight into the cache directory, so that new objects
+        # can be moved into place with a simple rename.
+        downloaded = utils.downloadFile(uri, self._cache_dir, headers=headers,
+                                        monitor=monitor, expected=expected, mirrors=mirrors)
+        if downloaded is None:
+            debugprint("Reusing cached copy of %s" % uri)
+        else:
+            entry = self._store(key, downloaded)
+
+        with self._lock:
+            # The object might have been evicted by a concurrent request while
+            # revalidating, in which case we simply download it again.
+            if os.path.exists(self._objectPath(entry['sha256'])):
+                entry['last_used'] = time.time()
+                self._saveIndex()
+                return self._linkObject(entry, dest_dir)
+
+        downloaded = utils.downloadFile(uri, self._cache_dir, monitor=monitor, expected=expected,
+                                        mirrors=mirrors)
+        entry = self._store(key, downloaded)
+        with self._lock:
+            return self._linkObject(entry, dest_dir)
+
+    def _store(self, key, downloaded):
+        object_path = self._objectPath(downloaded.hashes['sha256'])
+        try:
+            if os.path.exists(object_path):
+                # Same contents already cached (maybe from another URI).
+                os.remove(downloaded.path)
+            else:
+                os.rename(downloaded.path, object_path)
+        except OSError as e:
+            raise GLib.GError("Error storing %s in the download cache: %s" % (key, repr(e)))
+
+        entry = { 'sha256': downloaded.hashes['sha256'],
+                  'hashes': downloaded.hashes,
+                  'size': downloaded.size,
+                  'etag': downloaded.etag,
+                  'last_modified': downloaded.last_modified,
+                  'last_used': time.time() }
+
+        with self._lock:
+            self._getIndex()[key] = entry
+            self._evictIfNeeded(keep=entry['sha256'])
+            self._saveIndex()
+
+        debugprint("Stored %s in the download cache as %s" % (key, entry['sha256']))
+        return entry
+
+    def _linkObject(self, entry, dest_dir):
+        object_path = self._objectPath(entry['sha256'])
+        dest_path = os.path.join(dest_dir, entry['sha256'])
+        try:
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            try:
+                os.link(object_path, dest_path)
+            except OSError:
+                # Cache and destination live in different filesystems.
+                shutil.copyfile(object_path, dest_path)
+        except OSError as e:
+            raise GLib.GError("Error retrieving file from the download cache: %s" % repr(e))
+
+        return utils.DownloadedFile(dest_path, entry['size'], dict(entry['hashes']),
+                                    etag=entry.get('etag'),
+                                    last_modified=entry.get('last_modified'))
+
+    def _evictIfNeeded(self, keep=None):
+        # Several URIs might point to the same object, so we consider the
+        # most recent access through any of them when sorting by usage.
+        objects = {}
+        for uri, entry in self._index.items():
+            sha256 = entry['sha256']
+            last_used, size, uris = objects.get(sha256, (0, entry['size'], []))
+            uris.append(uri)
+            objects[sha256] = (max(last_used, entry['last_used']), size, uris)
+
+        total_size = sum(size for (last_used, size, uris) in objects.values())
+        by_usage = sorted(objects.items(), key=lambda item: item[1][0])
+        for sha256, (last_used, size, uris) in by_usage:
+            if total_size <= self._max_size:
+                break
+            if sha256 == keep:
+                continue
+
+            debugprint("Evicting %s (%d bytes) from the download cache" % (sha256, size))
+            try:
+                os.remove(self._objectPath(sha256))
+            except OSError:
+                pass
+            for uri in uris:
+                del self._index[uri]
+            total_size -= size
+
+    def _objectPath(self, sha256):
+        return os.path.join(self._objects_dir, sha256)
+
+    def _ensureCacheDir(self):
+        try:
+            os.makedirs(self._objects_dir, exist_ok=True)
+        except OSError as e:
+            raise GLib.GError("Cache directory could not be created: %s" % repr(e))
+
+    def _getIndex(self):
+        if self._index is None:
+            try:
+                with open(self._index_path, 'r') as index_file:
+                    self._index = json.load(index_file)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _saveIndex(self):
+        tmp_path = self._index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as index_file:
+                json.dump(self._index, index_file)
+            os.rename(tmp_path, self._index_path)
+        except OSError as e:
+            debugprint("Could not save the download cache index: %s" % repr(e))
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def getDefault():
+    """
+    Return the DownloadCache instance shared by the whole service.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = DownloadCache()
+        return _default_cache
@@ -20,261 +20,178 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import time
+
+# Taken as soon as possible, to measure the time needed to start the service.
+_script_start_time = time.monotonic()
+
+import authorization
 import config
 import dbus.exceptions
 import dbus.service
 import killtimer
 import os
-import pkgvalidator
-import shutil
-import subprocess
-import tempfile
+import scheduler
+import stats
+import sys
 import threading
-import time
-import utils
 
 from gi.repository import GLib
-from gi.repository import Polkit
 
 from debug import *
 
 CONFIG_PRINTING_BUS = 'com.endlessm.Config.Printing'
 CONFIG_PRINTING_PATH = '/com/endlessm/Config/Printing'
 CONFIG_PRINTING_IFACE = 'com.endlessm.Config.Printing'
+CONFIG_PRINTING_JOB_PATH = '/com/endlessm/Config/Printing/Job'
+CONFIG_PRINTING_JOB_IFACE = 'com.endlessm.Config.Printing.Job'
 
+# Time, in seconds, that finished jobs remain available on the bus, so that
+# their owners can still retrieve their result with Wait(). The service does
+# not exit while there are jobs on the bus, even if idle for longer than that.
+JOB_LINGER_TIMEOUT = 60
 
-class PrinterDriver:
-    """
-    General class representing a printer driver that can be installed
-    and which we can ask for a list of installed PPD files to.
-    """
-    def __init__(self, name):
-        self._name = name
-
-    def install(self):
-        debugprint("Installing printer driver '%s'..." % self._name)
-
-    def getInstalledPPDFiles(self):
-        return []
+# Module implementing the installation of drivers, loaded on first use.
+_printerdriver = None
+_printerdriver_lock = threading.Lock()
 
+def _getPrinterDriverModule():
+    """
+    Return the printerdriver module, importing it on first use, which also
+    removes the leftovers from previous installation attempts.
 
-class PrinterDriverOpenPrinting(PrinterDriver):
+    Loading it (and everything needed to install drivers) only when needed
+    makes the service claim its bus name and reply to other requests faster.
     """
-    Subclass of PrinterDriver, represents a type of driver that will be
-    retrieved from OpenPrinting.org, and which follows a certain structure.
+    global _printerdriver
+    with _printerdriver_lock:
+        if _printerdriver is None:
+            import printerdriver
+            printerdriver.PrinterDriverOpenPrinting.cleanupLeftovers()
+            _printerdriver = printerdriver
+        return _printerdriver
+
+def _getProcessAge():
     """
-    def __init__(self, args):
-        super().__init__("OpenPrinting")
-
-        if not args or 'uri' not in args:
-            raise TypeError("Can't find the URI parameter in %s" % repr(args))
-        self._uri = args['uri']
+    Return the number of seconds since the process was started (e.g. by D-Bus
+    activation), including the startup of the interpreter, or None if unknown.
+    """
+    try:
+        with open('/proc/self/stat', 'r') as stat_file:
+            # The command name, in parentheses, might contain spaces.
+            start_ticks = int(stat_file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
 
-        self._fingerprint = None
-        if 'fingerprint' in args:
-            self._fingerprint = args['fingerprint']
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
 
-        self._installedPPDs = []
-        self._temporary_dir = None
 
-    def install(self):
+class InstallJob(dbus.service.Object):
+    """
+    Class representing a driver installation started with StartInstall, exported
+    in the bus so that its owner can follow its progress, cancel it, and wait for
+    it to finish. Only the process that started the job can cancel it.
+    """
+    def __init__(self, bus, path, owner, type_, args):
+        super().__init__(bus, path)
+        self.path = path
+        self._owner = owner
+        self._type = type_
+        self._args = args
+        import utils
+        self._monitor = utils.ProgressMonitor(callback=self._progressCb)
+        self._finished = False
+        self._result = None
+        self._error = None
+        self._waiters = []
+
+    def run(self):
         """
-        Install a printer driver in the system by downloading it from
-        OpenPrinting.org, extracting its contents and making it available
-        to CUPS by placing it under a path reachable from /usr/share/ppd.
+        Worker function installing the driver, to be run from a worker thread.
         """
-        super().install()
-
-        try:
-            self._ensureTemporaryDir()
-            self._doInstall()
-        except Exception as e:
-            raise e
-        finally:
-            self._cleanupTemporaryFiles()
-
-    def _doInstall(self):
-        # Try to download the file pointed by the URI and validate it.
-        # If any of these operations fails an GLib.GError exception
-        # will be raised and handled by the run() function.
-        filepath = utils.downloadToTemporaryFile(self._uri, self._temporary_dir)
-
-        # If no GPG fingerpring is provided, the package is considered to
-        # be 'trusted' (e.g. client checked it does not contain binaries)
-        if self._fingerprint is not None:
-            validator = pkgvalidator.PackageValidator(self._uri, self._fingerprint,
-                                                      temporary_dir=self._temporary_dir)
-            if not validator.run(localfile=filepath):
-                raise GLib.GError("The package file could not be validated")
-
-        # Now that the package has been downloaded and validated, extract
-        # it to a temporary directory and begin its installation.
-        extraction_dir = os.path.join(self._temporary_dir, 'extract')
-        self._extractDriverPackage(filepath, extraction_dir)
-        try:
-            os.remove(filepath)
-        except OSError as e:
-            raise GLib.GError("Error removing file %s" % repr(e))
-
-        # For the purpose of this script, assume drivers from OpenPrinting will
-        # always be installed under '/opt' so bail out early if not the case.
-        try:
-            dircontents = os.listdir(extraction_dir)
-        except OSError as e:
-            raise GLib.GError("Error listing contents of directory: %s" % repr(e))
-
-        if len(dircontents) != 1 or dircontents[0] != 'opt':
-            raise GLib.GError("Driver packages not meant to be installed "
-                              "inside the /opt directory are not currently "
-                              "supported")
-
-        # Move the driver into the desired location, search for the directory
-        # containing the PPD files and create symlinks pointing there from the
-        # /var/lib/eos-config-printer/ppd  directory, so that CUPS can find them.
-        # Also, fill the self._installedPPDs list to report to the caller.
-        moved_dirs = self._deployDriverDirectories(extraction_dir)
-        self._installedPPDs = []
-        for path in moved_dirs:
-            debugprint("Searching for the directory containing PPD files")
-            ppd_files = self._searchForPPDFiles(path)
-            if ppd_files:
-                ppd_dirs = list(set([os.path.dirname(f) for f in ppd_files]))
-                debugprint("Found %d PPD directory(s)" % len(ppd_dirs))
-                self._createSymlinksForCUPS(ppd_dirs)
-            self._installedPPDs.extend(ppd_files)
-
-    def _ensureTemporaryDir(self):
-        if os.path.exists(config.TEMPORARY_DIR):
-            try:
-                # Make sure there are no leftovers from previous installation attempts.
-                dircontents = os.listdir(config.TEMPORARY_DIR)
-                for path in dircontents:
-                    abs_path = os.path.join(config.TEMPORARY_DIR, path)
-                    shutil.rmtree(abs_path, ignore_errors=True)
-            except OSError as e:
-                raise GLib.GError("Error listing contents of directory: %s" % repr(e))
-        else:
-            os.makedirs(config.TEMPORARY_DIR, exist_ok=True)
-
-        try:
-            self._temporary_dir = tempfile.mkdtemp(dir=config.TEMPORARY_DIR)
-            debugprint("Created temporary directory in %s" % self._temporary_dir)
-        except OSError as e:
-            self._temporary_dir = None
-            raise GLib.GError("Temporary directory could not be created: %s" % repr(e))
-
-    def _cleanupTemporaryFiles(self):
-        if self._temporary_dir:
-            shutil.rmtree(self._temporary_dir, ignore_errors=True)
-            debugprint("Removed temporary directory from %s" % self._temporary_dir)
-        self._temporary_dir = None
-
-    def getInstalledPPDFiles(self):
-        """
-        Return the list of installed PPD files for this driver, or an
-        empty list if no file has been installed.
-        """
-        return self._installedPPDs
-
-    def _extractDriverPackage(self, driver_path, dest_dir):
-        """
-        Extracts the content of a driver package (always a debian package for now),
-        pointed by driver_path, and places the result under dest_dir.
-        """
-        # FIXME: We could use the python-debian module, but for now just executing
-        # 'dpkg -x' is probably enough, as we are treating .deb files as simple
-        # 'tarballs', and we avoid pulling an extra dependency just for this task.
-        args = ['dpkg', '-x', driver_path, dest_dir]
-        new_environ = os.environ.copy()
-        new_environ['LC_ALL'] = 'C'
-        debugprint("Extracting contents for file %s into %s..." % (driver_path,
-                                                                   dest_dir))
         try:
-            process = subprocess.Popen(args, env=new_environ, close_fds=True,
-                                       stdin=subprocess.DEVNULL,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
-            process.wait()
+            self._monitor.checkCancelled()
+            printerdriver = _getPrinterDriverModule()
+            driver = printerdriver.PrinterDriverOpenPrinting(self._args, monitor=self._monitor)
+            driver.install()
+        except TypeError as e:
+            raise GLib.GError("Error initializing driver installer: %s" % repr(e))
+        except GLib.GError as e:
+            raise GLib.GError("Error installing printer driver: %s" % repr(e))
 
-            if process.returncode != 0:
-                raise GLib.GError("Error extracting the contents of %s" % driver_path)
-        except:
-            raise GLib.GError("An error has occurred executing %s" % repr(args))
+        return driver.getInstalledPPDFiles()
 
-    def _deployDriverDirectories(self, extraction_dir):
+    def finish(self, result, error):
         """
-        Move all the directories related to one driver from extraction_dir into
-        their definite location, under '/opt'.
-
-        Returns a list with the full path of the directories moved.
+        Record the result (or error) of the job and notify the callers waiting
+        for it. Must be called from the main thread.
         """
-        extracted_opt_dir = os.path.join(extraction_dir, 'opt')
-        try:
-            dircontents = os.listdir(extracted_opt_dir)
-        except OSError as e:
-            raise GLib.GError("Error listing contents of directory: %s" % repr(e))
-
-        copied_dirs = []
-        for path in dircontents:
-            debugprint("Driver package found: %s" % path)
-            src = os.path.join(extracted_opt_dir, path)
-            dest = os.path.join('/opt', path)
-
-            if os.path.exists(dest):
-                shutil.rmtree(dest, ignore_errors=True)
-
-            try:
-                debugprint("Copying %s into %s..." % (src, dest))
-                shutil.copytree(src, dest, symlinks=True)
-                copied_dirs.append(dest)
-
-            except shutil.Error as e:
-                raise GLib.GError("Error copying the files from %s into %s: %s"
-                                                % (src, dest, repr(e)))
-
-        return copied_dirs
-
-    def _searchForPPDFiles(self, base_dir):
+        self._finished = True
+        self._result = result
+        self._error = error
+        cancelled = error is not None and self._monitor.isCancelled()
+        self.Progress('cancelled' if cancelled else 'finished', 0, 0)
+
+        for (reply_cb, error_cb) in self._waiters:
+            self._replyWaiter(reply_cb, error_cb)
+        self._waiters = []
+
+    @dbus.service.signal(dbus_interface=CONFIG_PRINTING_JOB_IFACE, signature='stt')
+    def Progress(self, stage, bytes_done, bytes_total):
+        """
+        Emitted when the job enters a new stage, and periodically while in it.
         """
-        Looks for directories containing PPD files, and the paths to each of
-        those files, inside of the path referenced by base_dir.
+        pass
 
-        Return a list of paths to the installed PPDs, or an empty list otherwise.
+    @dbus.service.method(dbus_interface=CONFIG_PRINTING_JOB_IFACE,
+                         in_signature='', out_signature='',
+                         sender_keyword='sender')
+    def Cancel(self, sender=None):
         """
-        result = []
-        for root, dirs, files in os.walk(base_dir):
-            for file in files:
-                file_l = file.lower()
-                if file_l.endswith('.ppd') or file_l.endswith('.ppd.gz'):
-                    ppd_file_path = os.path.join(root, file)
-                    result.append(ppd_file_path)
-                    debugprint("PPD file found!: %s" % ppd_file_path)
+        Cancels the job, which stops downloading or extracting the package right
+        away. Jobs already deploying the driver into the system are not affected.
+        """
+        if sender != self._owner:
+            raise dbus.exceptions.DBusException("Only the owner of the job can cancel it")
 
-        debugprint("Found %d PPD file(s)" % len(result))
-        return result
+        debugprint("Cancelling job %s" % self.path)
+        self._monitor.cancel()
 
-    def _createSymlinksForCUPS(self, ppd_dirs):
+    @dbus.service.method(dbus_interface=CONFIG_PRINTING_JOB_IFACE,
+                         in_signature='', out_signature='as',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def Wait(self, reply_cb, error_cb):
         """
-        Creates a symlink to every path in ppd_dirs from a CUPS visible directory.
+        Waits for the job to finish, returning the list of installed PPD files.
         """
-        # First of all, ensure the CUPS visible directory is created.
-        os.makedirs(config.CUPS_VISIBLE_PPD_DIR, exist_ok=True)
+        if self._finished:
+            self._replyWaiter(reply_cb, error_cb)
+        else:
+            self._waiters.append((reply_cb, error_cb))
 
-        for path in ppd_dirs:
-            # Sanity check.
-            if not path.startswith('/opt'):
-                continue
+    def _replyWaiter(self, reply_cb, error_cb):
+        if self._error is not None:
+            error_cb(self._error)
+        else:
+            reply_cb(self._result)
 
-            # First we need to create an unique name for the symlink, and we do
-            # that by ignoring the '/opt' preffix and replacing '/' with '_'.
-            symlink_name = path[5:].replace('/', '_')
+    def _progressCb(self, stage, bytes_done, bytes_total):
+        # Called from the worker thread, while signals are emitted from the main one.
+        GLib.idle_add(self._emitProgress, stage, bytes_done, bytes_total)
 
-            symlink_path = os.path.join(config.CUPS_VISIBLE_PPD_DIR, symlink_name)
-            if os.path.exists(symlink_path):
-                os.unlink(symlink_path)
+    def _emitProgress(self, stage, bytes_done, bytes_total):
+        if not self._finished:
+            self.Progress(stage, bytes_done, bytes_total)
+        return False
 
-            os.symlink(path, symlink_path)
-            debugprint("Symlink created: %s -> %s" % (symlink_path, path))
+    def unexport(self):
+        """
+        Remove the finished job from the bus.
+        """
+        debugprint("Removing finished job %s from the bus" % self.path)
+        self.remove_from_connection()
 
 
 class ConfigPrintingService(dbus.service.Object):
@@ -285,19 +202,32 @@ class ConfigPrintingService(dbus.service.Object):
     # We only support drivers from OpenPrinting.org for now.
     DriverTypeOpenPrinting = 1
 
-    def __init__(self):
+    def __init__(self, measure_startup=False):
+        # Claim the bus name first, so that D-Bus can dispatch to us as soon as possible.
         self.bus = dbus.SystemBus()
         bus_name = dbus.service.BusName(CONFIG_PRINTING_BUS, bus=self.bus)
         super().__init__(bus_name, CONFIG_PRINTING_PATH)
-        self._polkit_authority = None
+
+        # Times, in seconds since the script started, of the milestones reached
+        # while starting the service, until the reply to the first request.
+        self._measure_startup = measure_startup
+        self._startup_milestones = []
+        self._startup_lock = threading.Lock()
+        self._markStartupMilestone('bus_name')
+        self._authorizer = authorization.Authorizer(self.bus)
         self._killtimer = None
-        self._driver = None
         self._loop = None
 
+        # Requests are processed by a fixed pool of worker threads, which
+        # also makes sure requests for the same package are only processed once.
+        self._scheduler = scheduler.JobScheduler()
+        self._next_job_id = 0
+
     def start(self):
         """
-        Starts the D-Bus service, which will remain running 30 seconds after
-        having finished dispatching the last request.
+        Starts the D-Bus service, which will remain running IDLE_TIMEOUT seconds
+        after having finished dispatching the last request, or up to IDLE_MAX_TIMEOUT
+        seconds while requests keep arriving at a steady pace.
         """
         if self._loop is None:
             self._loop = GLib.MainLoop()
@@ -306,7 +236,11 @@ class ConfigPrintingService(dbus.service.Object):
             debugprint("Service already running. Nothing to do")
             return
 
-        self._killtimer = killtimer.KillTimer(killfunc=self.stop)
+        self._killtimer = killtimer.KillTimer(timeout=config.IDLE_TIMEOUT,
+                                              killfunc=self.stop,
+                                              max_timeout=config.IDLE_MAX_TIMEOUT,
+                                              history_file=config.ARRIVALS_FILE)
+        self._markStartupMilestone('main_loop')
         self._loop.run()
 
     def stop(self):
@@ -325,78 +259,320 @@ class ConfigPrintingService(dbus.service.Object):
                          async_callbacks=('reply_cb', 'error_cb'))
     def InstallDriver(self, type_, args, reply_cb, error_cb, sender=None):
         """
-        Installs a Printer driver by type_ and uri in a separate thread,
+        Installs a Printer driver by type_ and uri in a worker thread,
         invoking reply_cb or error_cb when done.
 
         Note: The only supported type for now is '1' ("OpenPrinting driver").
         """
-        thread = threading.Thread(target=self._installDriverThreadFunc,
-                                  kwargs={ 'type_': type_,
-                                           'args': args,
-                                           'reply_cb': reply_cb,
-                                           'error_cb': error_cb,
-                                           'sender' : sender })
         self._killtimer.add_hold()
-        thread.start()
 
-    def _installDriverThreadFunc(self, type_, args, reply_cb, error_cb, sender):
+        # Authorization is checked for every caller, while the installation
+        # job itself is shared by all the callers asking for the same driver.
+        def authorization_cb(authorized, error):
+            if error is not None:
+                self._reportError(error_cb, GLib.GError("Error checking authorization: %s" % repr(error)))
+            elif not authorized:
+                self._reportError(error_cb, GLib.GError("Method not authorized"))
+            elif not self._driversIsSupported(type_):
+                self._reportError(error_cb, GLib.GError("Unsupported driver type: %d" % type_))
+            else:
+                self._scheduleInstallDriver(type_, args, reply_cb, error_cb)
+
+        self._methodIsAuthorized('InstallDriver', sender, authorization_cb)
+
+    @dbus.service.method(dbus_interface=CONFIG_PRINTING_IFACE,
+                         in_signature='a(ua{ss})', out_signature='a{s(bsas)}',
+                         sender_keyword='sender',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def InstallDrivers(self, drivers, reply_cb, error_cb, sender=None):
+        """
+        Installs a list of Printer drivers, given as (type_, args) tuples, in a
+        worker thread, invoking reply_cb with the result for every URI when done,
+        or error_cb if the whole request could not be processed.
+        """
+        self._killtimer.add_hold()
+
+        # Authorization is checked only once for the whole list of drivers.
+        def authorization_cb(authorized, error):
+            if error is not None:
+                self._reportError(error_cb, GLib.GError("Error checking authorization: %s" % repr(error)))
+            elif not authorized:
+                self._reportError(error_cb, GLib.GError("Method not authorized"))
+            else:
+                self._scheduleInstallDrivers(drivers, reply_cb)
+
+        self._methodIsAuthorized('InstallDrivers', sender, authorization_cb)
+
+    @dbus.service.method(dbus_interface=CONFIG_PRINTING_IFACE,
+                         in_signature='ua{ss}', out_signature='o',
+                         sender_keyword='sender',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def StartInstall(self, type_, args, reply_cb, error_cb, sender=None):
+        """
+        Starts installing a Printer driver by type_ and uri in a worker thread,
+        invoking reply_cb right away with the path of a job object that can be
+        used to follow the installation, or error_cb if it could not be started.
+        """
+        self._killtimer.add_hold()
+
+        def authorization_cb(authorized, error):
+            if error is not None:
+                self._reportError(error_cb, GLib.GError("Error checking authorization: %s" % repr(error)))
+            elif not authorized:
+                self._reportError(error_cb, GLib.GError("Method not authorized"))
+            elif not self._driversIsSupported(type_):
+                self._reportError(error_cb, GLib.GError("Unsupported driver type: %d" % type_))
+            else:
+                self._startInstallJob(type_, args, reply_cb, error_cb, sender)
+
+        self._methodIsAuthorized('StartInstall', sender, authorization_cb)
+
+    @dbus.service.method(dbus_interface=CONFIG_PRINTING_IFACE,
+                         in_signature='ua{ss}', out_signature='s',
+                         sender_keyword='sender',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def PrefetchDriver(self, type_, args, reply_cb, error_cb, sender=None):
+        """
+        Downloads and validates a Printer driver by type_ and uri in a worker
+        thread, without installing it, invoking reply_cb with the SHA256 digest
+        of the package when done, or error_cb otherwise. Installing the same
+        driver later on will not need to download nor validate it again.
+        """
+        self._killtimer.add_hold()
+
+        def authorization_cb(authorized, error):
+            if error is not None:
+                self._reportError(error_cb, GLib.GError("Error checking authorization: %s" % repr(error)))
+            elif not authorized:
+                self._reportError(error_cb, GLib.GError("Method not authorized"))
+            elif not self._driversIsSupported(type_):
+                self._reportError(error_cb, GLib.GError("Unsupported driver type: %d" % type_))
+            else:
+                self._schedulePrefetchDriver(type_, args, reply_cb, error_cb)
+
+        self._methodIsAuthorized('PrefetchDriver', sender, authorization_cb)
+
+    @dbus.service.method(dbus_interface=CONFIG_PRINTING_IFACE,
+                         in_signature='', out_signature='a(sssas)')
+    def ListInstalledDrivers(self):
         """
-        Worker function to be executed in a separate thread to install the driver.
+        Returns the list of drivers installed through this service, as tuples
+        with the URI, GPG fingerprint (or an empty string), SHA256 digest of the
+        package and the list of absolute paths to the PPD files installed.
         """
-        # Check Polkit authorization policies.
+        self._killtimer.alive()
+        import registry
         try:
-            authorized = self._methodIsAuthorized('InstallDriver', sender)
+            drivers = registry.getDefault().listDrivers()
         except GLib.GError as e:
-            self._reportError(error_cb, GLib.GError("Error checking authorization: %s" % repr(e)))
-            return
+            raise dbus.exceptions.DBusException("Error reading installed drivers: %s" % repr(e))
 
-        if not authorized:
-            self._reportError(error_cb, GLib.GError("Method not authorized"))
-            return
+        self._markStartupMilestone('first_reply')
+        return [(driver.uri, driver.fingerprint or '', driver.hashes.get('sha256', ''), driver.ppds)
+                for driver in drivers]
+
+    @dbus.service.method(dbus_interface=CONFIG_PRINTING_IFACE,
+                         in_signature='', out_signature='tttt')
+    def GetPPDStorageUsage(self):
+        """
+        Returns the disk usage of the PPD files installed through this service:
+        the number of different PPD files stored, the number of installed PPD
+        files sharing them, the number of bytes they take on disk, and the number
+        of bytes saved by not duplicating identical PPD files.
+        """
+        self._killtimer.alive()
+        import ppdstore
+        usage = ppdstore.getDefault().getUsage()
+
+        self._markStartupMilestone('first_reply')
+        return (usage.stored_files, usage.linked_files, usage.stored_bytes, usage.saved_bytes)
+
+    @dbus.service.method(dbus_interface=CONFIG_PRINTING_IFACE,
+                         in_signature='', out_signature='ada{s(tdat)}a{st}')
+    def GetStatistics(self):
+        """
+        Returns the statistics collected since the service was started: the upper
+        bounds of the buckets of the histograms, in seconds, the histogram of the
+        time spent in every stage of the installations, as tuples with the number
+        of occurrences, the total time and the number of occurrences in every
+        bucket, and the value of every counter (e.g. bytes downloaded).
+        """
+        self._killtimer.alive()
+        self._markStartupMilestone('first_reply')
+        statistics = stats.getDefault()
+        return ([float(bound) for bound in stats.HISTOGRAM_BUCKETS],
+                statistics.getHistograms(), statistics.getCounters())
+
+    def _scheduleInstallDriver(self, type_, args, reply_cb, error_cb):
+        """
+        Schedule the installation of the driver, or attach to the installation of
+        the same driver if already in progress, reporting the result when done.
+        """
+        def install_cb(job):
+            if job.error is not None:
+                self._reportError(error_cb, job.error)
+            else:
+                self._reportSuccess(reply_cb, job.result)
+
+        try:
+            self._scheduler.submit(lambda: self._installDriverJobFunc(args), install_cb,
+                                   key=self._getInstallJobKey(type_, args))
+        except GLib.GError as e:
+            self._reportError(error_cb, e)
 
-        # Check driver type.
-        if not self._driversIsSupported(type_):
-            self._reportError(error_cb, GLib.GError("Unsupported driver type: %d" % type_))
+    def _scheduleInstallDrivers(self, drivers, reply_cb):
+        """
+        Schedule the installation of a list of drivers, each one of them as a
+        separate job (attached to the installation of the same driver if already
+        in progress), reporting the result for all of them once they are done.
+        All of them are submitted as a single batch, which takes a single place
+        in the queue of the scheduler, however many drivers it has.
+
+        The result is a dictionary mapping the URI of every driver to a tuple with
+        whether it was installed, the error message if not, and its PPD files.
+        """
+        results = {}
+        to_install = {}
+        for (type_, args) in drivers:
+            uri = args.get('uri', '')
+            if uri in results or uri in to_install:
+                continue
+            if not self._driversIsSupported(type_):
+                results[uri] = (False, "Unsupported driver type: %d" % type_, [])
+                continue
+            to_install[uri] = (type_, args)
+
+        if not to_install:
+            self._reportSuccess(reply_cb, results)
             return
 
+        # Jobs finish in the worker threads, in any order.
+        lock = threading.Lock()
+        remaining = [len(to_install)]
+
+        def finish(uri, result):
+            with lock:
+                results[uri] = result
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            self._reportSuccess(reply_cb, results)
+
+        def install_cb(job, uri):
+            if job.error is not None:
+                debugprint("Error installing driver from %s: %s" % (uri, repr(job.error)))
+                finish(uri, (False, str(job.error), []))
+            else:
+                finish(uri, (True, '', job.result))
+
+        # Packages are installed in parallel, up to the number of workers, while
+        # the repository metadata shared by several of them is only fetched and
+        # verified once, as the validators wait for each other through the cache.
+        batch = [(lambda args=args: self._installDriverJobFunc(args),
+                  lambda job, uri=uri: install_cb(job, uri),
+                  self._getInstallJobKey(type_, args))
+                 for (uri, (type_, args)) in to_install.items()]
+        try:
+            self._scheduler.submitBatch(batch)
+        except GLib.GError as e:
+            for uri in to_install:
+                finish(uri, (False, str(e), []))
+
+    def _getInstallJobKey(self, type_, args):
+        # Requests to install the same driver share a single job.
+        return (type_, args.get('uri'), args.get('fingerprint'))
+
+    def _installDriverJobFunc(self, args):
+        """
+        Worker function to be executed in a worker thread to install the driver.
+
+        Returns the list of installed PPD files.
+        """
         try:
             # Only OpenPrinting supported for now.
-            self._driver = PrinterDriverOpenPrinting(args)
-            self._driver.install()
+            driver = _getPrinterDriverModule().PrinterDriverOpenPrinting(args)
+            driver.install()
         except TypeError as e:
-            self._reportError(error_cb, GLib.GError("Error initializing driver installer: %s" % repr(e)))
-            return
+            raise GLib.GError("Error initializing driver installer: %s" % repr(e))
         except GLib.GError as e:
-            self._reportError(error_cb, GLib.GError("Error installing printer driver: %s" % repr(e)))
-            return
+            raise GLib.GError("Error installing printer driver: %s" % repr(e))
 
-        # All good, let the caller know that.
-        self._reportSuccess(reply_cb)
+        return driver.getInstalledPPDFiles()
 
-    def _methodIsAuthorized(self, method_name, sender):
+    def _schedulePrefetchDriver(self, type_, args, reply_cb, error_cb):
         """
-        Return True if the method is authorized by PolicyKit, or False otherwise.
+        Schedule prefetching the driver, or attach to the prefetch of the same
+        driver if already in progress, reporting the result when done.
         """
-        debugprint("Checking authorization for method %s and sender %s" %
-                   (method_name, sender))
+        def prefetch_cb(job):
+            if job.error is not None:
+                self._reportError(error_cb, job.error)
+            else:
+                self._reportSuccess(reply_cb, job.result)
 
-        # Lazy initialization of the Polkit authority object.
-        if self._polkit_authority is None:
-            self._polkit_authority = Polkit.Authority.get_sync(None)
+        key = ('prefetch', type_, args.get('uri'), args.get('fingerprint'))
+        try:
+            self._scheduler.submit(lambda: self._prefetchDriverJobFunc(args), prefetch_cb, key=key)
+        except GLib.GError as e:
+            self._reportError(error_cb, e)
 
-        auth_result = None
-        subject = Polkit.SystemBusName.new(sender)
-        action_id = ".".join([CONFIG_PRINTING_IFACE, method_name])
+    def _prefetchDriverJobFunc(self, args):
+        """
+        Worker function to be executed in a worker thread to prefetch the driver.
 
-        auth_result = self._polkit_authority.check_authorization_sync(subject, action_id, None,
-                                                                      Polkit.CheckAuthorizationFlags.NONE,
-                                                                      None)
-        if auth_result is None:
-            return False
+        Returns the SHA256 digest of the package.
+        """
+        try:
+            # Only OpenPrinting supported for now.
+            driver = _getPrinterDriverModule().PrinterDriverOpenPrinting(args)
+            return driver.prefetch()
+        except TypeError as e:
+            raise GLib.GError("Error initializing driver installer: %s" % repr(e))
+        except GLib.GError as e:
+            raise GLib.GError("Error prefetching printer driver: %s" % repr(e))
+
+    def _startInstallJob(self, type_, args, reply_cb, error_cb, sender):
+        # Job objects are exported and finished from the main thread only, which
+        # is where the authorization callbacks leading here are called from.
+        path = "%s/%d" % (CONFIG_PRINTING_JOB_PATH, self._next_job_id)
+        self._next_job_id += 1
+        install_job = InstallJob(self.bus, path, sender, type_, args)
+
+        def install_cb(job):
+            GLib.idle_add(self._finishInstallJob, install_job, job)
+
+        # Every job has its own monitor, so they are never coalesced: otherwise,
+        # cancelling one of them would cancel the rest of them too.
+        try:
+            self._scheduler.submit(install_job.run, install_cb)
+        except GLib.GError as e:
+            install_job.remove_from_connection()
+            self._reportError(error_cb, e)
+            return
+
+        debugprint("Started installation job %s" % path)
+        reply_cb(dbus.ObjectPath(path))
+        self._markStartupMilestone('first_reply')
 
-        retval = auth_result.get_is_authorized()
-        debugprint("Method is %sAUTHORIZED" % ("" if retval else "NOT "))
-        return retval
+    def _finishInstallJob(self, install_job, job):
+        # The hold taken when the job was started is kept until it is removed
+        # from the bus, so that its owner can still call Wait() until then.
+        install_job.finish(job.result, job.error)
+        GLib.timeout_add_seconds(JOB_LINGER_TIMEOUT, self._unexportInstallJob, install_job)
+        return False
+
+    def _unexportInstallJob(self, install_job):
+        install_job.unexport()
+        self._killtimer.remove_hold()
+        return False
+
+    def _methodIsAuthorized(self, method_name, sender, callback):
+        """
+        Check whether the method is authorized by PolicyKit for sender, without
+        blocking, and call callback(authorized, error) from the main loop once known.
+        """
+        action_id = ".".join([CONFIG_PRINTING_IFACE, method_name])
+        self._authorizer.check(sender, action_id, callback)
 
     def _driversIsSupported(self, type_):
         """
@@ -405,25 +581,53 @@ class ConfigPrintingService(dbus.service.Object):
         # Only OpenPrinting drivers supported for now.
         return type_ == self.DriverTypeOpenPrinting
 
+    def _markStartupMilestone(self, milestone):
+        """
+        Record the time when a milestone of the startup of the service was
+        reached, reporting all of them once the first request is replied.
+        """
+        with self._startup_lock:
+            if self._startup_milestones is None:
+                return
+
+            elapsed = time.monotonic() - _script_start_time
+            self._startup_milestones.append((milestone, elapsed))
+            if milestone != 'first_reply':
+                return
+
+            milestones = self._startup_milestones
+            self._startup_milestones = None
+
+        # Time to first reply since the process was started, if known.
+        process_age = _getProcessAge()
+        if process_age is not None:
+            milestones.append(('first_reply_since_exec', process_age))
+        stats.getDefault().record('startup', milestones[-1][1])
+
+        report = ", ".join("%s: %.3fs" % milestone for milestone in milestones)
+        debugprint("Startup times: %s" % report)
+        if self._measure_startup:
+            print("Startup times: %s" % report, file=sys.stderr)
+
     def _reportError(self, error_cb, error_data):
         """
         Call error_cb passing error_data as parameter, and restores the timer
-        that will kill this D-Bus service after 30 seconds if not invoked again.
+        that will kill this D-Bus service if not invoked again.
         """
         debugprint("Reporting error to caller process: %s" % repr(error_data))
         error_cb(error_data)
+        self._markStartupMilestone('first_reply')
         self._killtimer.remove_hold()
 
-    def _reportSuccess(self, reply_cb):
+    def _reportSuccess(self, reply_cb, result):
         """
-        Call reply_cb passing the list of installed PPD files as parameter,
-        and restores the timer that will kill this D-Bus service after 30 seconds
+        Call reply_cb passing the result (e.g. the list of installed PPD files)
+        as parameter, and restores the timer that will kill this D-Bus service
         if not invoked again.
         """
-        installed_PPDs = self._driver.getInstalledPPDFiles()
-        reply_cb(installed_PPDs)
-        debugprint("Reporting success to caller process. Installed files: %s"
-                   % installed_PPDs)
+        reply_cb(result)
+        debugprint("Reporting success to caller process. Result: %s" % repr(result))
+        self._markStartupMilestone('first_reply')
         self._killtimer.remove_hold()
 
 
@@ -434,8 +638,9 @@ class ConfigPrintingClient:
     This class expects a list of arguments in its constructor, with the list of
     parameters needed to determine type and source URI of the printer driver.
     """
-    def __init__(self, args):
+    def __init__(self, args, prefetch=False):
         self._args = args
+        self._prefetch = prefetch
         self._loop = None
 
     def start(self):
@@ -453,15 +658,25 @@ class ConfigPrintingClient:
         bus = dbus.SystemBus()
         obj = bus.get_object(CONFIG_PRINTING_BUS, CONFIG_PRINTING_PATH)
 
+        if self._prefetch:
+            self._startPrefetch(obj, type_, args)
+            return
+
         try:
             debugprint("Executing remote method from client...")
-            obj.InstallDriver(type_, args,
-                              dbus_interface=CONFIG_PRINTING_IFACE,
-                              reply_handler=self._installDriverReplyCb,
-                              error_handler=self._installDriverErrorCb,
-                              timeout=GLib.MAXINT32/1000)
+            job_path = obj.StartInstall(type_, args, dbus_interface=CONFIG_PRINTING_IFACE)
+            debugprint("Installation job started: %s" % job_path)
+
+            job = bus.get_object(CONFIG_PRINTING_BUS, job_path)
+            job.connect_to_signal('Progress', self._progressCb,
+                                  dbus_interface=CONFIG_PRINTING_JOB_IFACE)
+            job.Wait(dbus_interface=CONFIG_PRINTING_JOB_IFACE,
+                     reply_handler=self._installDriverReplyCb,
+                     error_handler=self._installDriverErrorCb,
+                     timeout=GLib.MAXINT32/1000)
         except dbus.exceptions.DBusException as e:
             debugprint("Unable to execute remote method: %s" % e.get_dbus_message())
+            return
 
         self._loop = GLib.MainLoop()
         self._loop.run()
@@ -469,6 +684,23 @@ class ConfigPrintingClient:
     def stop(self):
         self._loop.quit()
 
+    def _startPrefetch(self, obj, type_, args):
+        try:
+            debugprint("Executing remote method from client...")
+            sha256 = obj.PrefetchDriver(type_, args, dbus_interface=CONFIG_PRINTING_IFACE,
+                                        timeout=GLib.MAXINT32/1000)
+        except dbus.exceptions.DBusException as e:
+            debugprint("Error executing remote method: %s" % e.get_dbus_message())
+            return
+
+        debugprint("Remote method successfully executed. Prefetched package: %s" % sha256)
+
+    def _progressCb(self, stage, bytes_done, bytes_total):
+        if bytes_total:
+            debugprint("Installation progress: %s (%d/%d bytes)" % (stage, bytes_done, bytes_total))
+        else:
+            debugprint("Installation progress: %s" % stage)
+
     def _installDriverReplyCb(self, reply):
         debugprint("Remote method successfully executed. Installed PPD files: %s"
                    % reply)
@@ -486,8 +718,11 @@ if __name__ == '__main__':
     DBusGMainLoop(set_as_default=True)
 
     run_client = False
+    prefetch = False
+    measure_startup = False
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], [], ['debug', 'client'])
+        optlist, args = getopt.getopt(sys.argv[1:], [], ['debug', 'client', 'prefetch',
+                                                         'measure-startup'])
     except getopt.GetoptError as e:
         print("Error parsing command line: %s" % e)
         sys.exit(2)
@@ -497,13 +732,17 @@ if __name__ == '__main__':
             set_debugging(True)
         elif opt == '--client':
             run_client = True
+        elif opt == '--prefetch':
+            prefetch = True
+        elif opt == '--measure-startup':
+            measure_startup = True
 
     if run_client:
-        client = ConfigPrintingClient(args)
+        client = ConfigPrintingClient(args, prefetch=prefetch)
         client.start()
         sys.exit(0)
 
     debugprint("Service running...")
-    service = ConfigPrintingService()
+    service = ConfigPrintingService(measure_startup=measure_startup)
     service.start()
     debugprint("Service stopping...")
@@ -20,14 +20,43 @@
 ## along with this program; if not, write to the Free Software
 ## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import json
+import os
 import threading
+import time
 
 from gi.repository import GLib
 
 from debug import *
 
+# Number of recent request arrivals used to estimate the rate of requests.
+ARRIVALS_HISTORY = 8
+
+# Minimum number of intervals between requests, all of them shorter than the
+# maximum timeout, for the traffic to be considered steady.
+MIN_STEADY_INTERVALS = 2
+
+# Margin applied over the longest recent interval between requests.
+TIMEOUT_MARGIN = 1.5
+
 class KillTimer:
-    def __init__ (self, timeout=30, killfunc=None):
+    """
+    Timer calling killfunc once no hold has been kept for a while.
+
+    If max_timeout is bigger than timeout, the time to wait is adapted to the
+    rate of requests (i.e. calls to add_hold and alive): while requests keep
+    arriving at steady intervals not longer than max_timeout, it is stretched
+    to cover the longest of the recent intervals, up to max_timeout, going
+    back to timeout as soon as an interval longer than max_timeout is seen.
+
+    Arrival times are kept in history_file, if passed, so that they survive
+    the process when it exits and gets started again (e.g. D-Bus activation).
+    """
+    def __init__ (self, timeout=30, killfunc=None, max_timeout=None, history_file=None):
+        self._base_timeout = timeout
+        self._max_timeout = max (timeout, max_timeout or timeout)
+        self._history_file = history_file
+        self._arrivals = self._load_arrivals ()
         self._timeout = timeout
         self._killfunc = killfunc
         self._holds = 0
@@ -35,6 +64,7 @@ class KillTimer:
         self._lock = threading.Lock()
 
     def _add_timeout (self):
+        self._timeout = self._compute_timeout ()
         self._timer = GLib.timeout_add_seconds (self._timeout, self._kill)
 
     def _kill (self):
@@ -46,6 +76,7 @@ class KillTimer:
 
     def add_hold (self):
         self._lock.acquire()
+        self._request_arrived ()
         if self._holds == 0:
             debugprint ("Kill timer stopped")
             GLib.source_remove (self._timer)
@@ -58,13 +89,63 @@ class KillTimer:
         if self._holds > 0:
             self._holds -= 1
             if self._holds == 0:
-                debugprint ("Kill timer started")
                 self._add_timeout ()
+                debugprint ("Kill timer started (%ds)" % self._timeout)
         self._lock.release()
 
     def alive (self):
         self._lock.acquire()
+        self._request_arrived ()
         if self._holds == 0:
             GLib.source_remove (self._timer)
             self._add_timeout ()
         self._lock.release()
+
+    def _request_arrived (self):
+        if self._max_timeout == self._base_timeout:
+            return
+
+        # Wall clock time, as it is compared with that of previous processes.
+        now = time.time ()
+        if self._arrivals and not 0 <= now - self._arrivals[-1] <= self._max_timeout:
+            debugprint ("No requests in a while, going back to %ds timeout" % self._base_timeout)
+            self._arrivals = []
+
+        self._arrivals = (self._arrivals + [now])[-ARRIVALS_HISTORY:]
+        self._save_arrivals ()
+
+    def _compute_timeout (self):
+        intervals = [b - a for (a, b) in zip (self._arrivals, self._arrivals[1:])]
+        if len (intervals) < MIN_STEADY_INTERVALS:
+            return self._base_timeout
+
+        timeout = int (max (intervals) * TIMEOUT_MARGIN) + 1
+        return min (self._max_timeout, max (self._base_timeout, timeout))
+
+    def _load_arrivals (self):
+        if self._history_file is None or self._max_timeout == self._base_timeout:
+            return []
+
+        try:
+            with open (self._history_file, 'r') as history:
+                arrivals = [float (arrival) for arrival in json.load (history)]
+        except (OSError, ValueError, TypeError):
+            return []
+
+        # Forget everything if the last request is too old to be relevant.
+        if not arrivals or not 0 <= time.time () - arrivals[-1] <= self._max_timeout:
+            return []
+        return arrivals[-ARRIVALS_HISTORY:]
+
+    def _save_arrivals (self):
+        if self._history_file is None:
+            return
+
+        tmp_path = self._history_file + '.tmp'
+        try:
+            os.makedirs (os.path.dirname (self._history_file), exist_ok=True)
+            with open (tmp_path, 'w') as history:
+                json.dump (self._arrivals, history)
+            os.rename (tmp_path, self._history_file)
+        except OSError as e:
+            debugprint ("Could not save arrival times: %s" % repr (e))
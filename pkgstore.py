@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+#
+# pkgstore.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import config
+import json
+import os
+import shutil
+import threading
+import time
+import utils
+
+from gi.repository import GLib
+
+from debug import *
+
+
+class StoredPackage:
+    """
+    Class representing a driver package kept in the PackageStore, downloaded
+    from uri and validated against the GPG key identified by fingerprint (or
+    None, if it was trusted as it is), along with its size and digests.
+    """
+    def __init__(self, uri, fingerprint, size, hashes, stored_time):
+        self.uri = uri
+        self.fingerprint = fingerprint
+        self.size = size
+        self.hashes = hashes
+        self.stored_time = stored_time
+
+    def toDict(self):
+        return { 'uri': self.uri,
+                 'fingerprint': self.fingerprint,
+                 'size': self.size,
+                 'hashes': self.hashes,
+                 'stored_time': self.stored_time }
+
+
+class PackageStore:
+    """
+    Class keeping driver packages that have already been downloaded and
+    validated ahead of their installation (i.e. prefetched), indexed by URI and
+    GPG key fingerprint, so that installing them later on does not require any
+    network access.
+
+    Packages are stored only once under the 'objects' subdirectory, named after
+    the SHA256 digest of their contents, and are dropped once installed, or
+    once they have been kept for longer than max_age seconds.
+    """
+    def __init__(self, store_dir=config.PACKAGE_STORE_DIR, max_age=config.PACKAGE_STORE_MAX_AGE):
+        self._store_dir = store_dir
+        self._objects_dir = os.path.join(store_dir, 'objects')
+        self._index_path = os.path.join(store_dir, 'index.json')
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._index = None
+
+    def add(self, uri, fingerprint, downloaded):
+        """
+        Keep a copy of the validated package described by the DownloadedFile
+        object passed, replacing whatever was stored for the same URI and
+        fingerprint. The file passed is left in place, for the caller to remove.
+
+        Return the StoredPackage object created.
+        """
+        try:
+            os.makedirs(self._objects_dir, exist_ok=True)
+        except OSError as e:
+            raise GLib.GError("Package store directory could not be created: %s" % repr(e))
+
+        package = StoredPackage(uri, fingerprint, downloaded.size,
+                                dict(downloaded.hashes), time.time())
+        with self._lock:
+            object_path = self._objectPath(package.hashes['sha256'])
+            try:
+                if not os.path.exists(object_path):
+                    self._copyFile(downloaded.path, object_path)
+            except OSError as e:
+                raise GLib.GError("Error storing %s in the package store: %s" % (uri, repr(e)))
+
+            self._getIndex()[self._getKey(uri, fingerprint)] = package.toDict()
+            self._expireOldEntries()
+            self._saveIndex()
+
+        debugprint("Stored package from %s as %s" % (uri, package.hashes['sha256']))
+        return package
+
+    def lookup(self, uri, fingerprint):
+        """
+        Return the StoredPackage kept for uri and fingerprint, or None if not found.
+        """
+        with self._lock:
+            data = self._getIndex().get(self._getKey(uri, fingerprint))
+            if data is None:
+                return None
+
+            package = StoredPackage(**data)
+            age = time.time() - package.stored_time
+            if age < 0 or age >= self._max_age or \
+               not os.path.exists(self._objectPath(package.hashes['sha256'])):
+                return None
+        return package
+
+    def retrieve(self, package, dest_dir):
+        """
+        Make a stored package available under dest_dir, returning a DownloadedFile
+        object for it, which can be freely removed by the caller once no longer needed.
+        """
+        object_path = self._objectPath(package.hashes['sha256'])
+        dest_path = os.path.join(dest_dir, package.hashes['sha256'])
+        try:
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            self._copyFile(object_path, dest_path)
+        except OSError as e:
+            raise GLib.GError("Error retrieving %s from the package store: %s" %
+                              (package.uri, repr(e)))
+
+        return utils.DownloadedFile(dest_path, package.size, dict(package.hashes))
+
+    def discard(self, uri, fingerprint):
+        """
+        Drop the package stored for uri and fingerprint, if any (e.g. once installed).
+        """
+        with self._lock:
+            if self._getIndex().pop(self._getKey(uri, fingerprint), None) is None:
+                return
+            self._removeUnreferencedObjects()
+            self._saveIndex()
+        debugprint("Removed package from %s from the package store" % uri)
+
+    def _expireOldEntries(self):
+        now = time.time()
+        for key, data in list(self._index.items()):
+            age = now - data['stored_time']
+            if age < 0 or age >= self._max_age:
+                debugprint("Package from %s expired in the package store" % data['uri'])
+                del self._index[key]
+        self._removeUnreferencedObjects()
+
+    def _removeUnreferencedObjects(self):
+        referenced = set(data['hashes']['sha256'] for data in self._index.values())
+        try:
+            names = os.listdir(self._objects_dir)
+        except OSError:
+            return
+
+        for name in names:
+            if name not in referenced:
+                try:
+                    os.remove(os.path.join(self._objects_dir, name))
+                except OSError:
+                    pass
+
+    def _copyFile(self, src, dest):
+        try:
+            os.link(src, dest)
+        except OSError:
+            # Source and destination live in different filesystems.
+            shutil.copyfile(src, dest)
+
+    def _objectPath(self, sha256):
+        return os.path.join(self._objects_dir, sha256)
+
+    def _getKey(self, uri, fingerprint):
+        return "%s %s" % (uri, fingerprint or '')
+
+    def _getIndex(self):
+        if self._index is None:
+            try:
+                with open(self._index_path, 'r') as index_file:
+                    self._index = json.load(index_file)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _saveIndex(self):
+        tmp_path = self._index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as index_file:
+                json.dump(self._index, index_file)
+            os.rename(tmp_path, self._index_path)
+        except OSError as e:
+            debugprint("Could not save the package store index: %s" % repr(e))
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+def getDefault():
+    """
+    Return the PackageStore instance shared by the whole service.
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = PackageStore()
+        return _default_store
@@ -20,12 +20,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import aptindex
 import config
+import downloadcache
 import gnupg
 import hashlib
+import json
 import os
-import re
 import shutil
+import stats
+import threading
+import time
 import utils
 
 from gi.repository import GLib
@@ -37,56 +42,262 @@ class PackageValidator:
     """
     Class that allows validating a debian package based on its full URL and the
     fingerprint of the GPG public key used to sign the source APT repository.
+
+    If a utils.MirrorSet is passed via mirrors, the package and the metadata
+    might be downloaded from any of the mirrors of the repository, as all of
+    them are validated against the signature of its Release file anyway.
     """
-    def __init__(self, uri, fingerprint, temporary_dir=config.TEMPORARY_DIR):
+    def __init__(self, uri, fingerprint, temporary_dir=config.TEMPORARY_DIR, mirrors=None):
         self._uri = uri
         self._fingerprint = fingerprint
         self._temporary_dir = temporary_dir
+        self._mirrors = mirrors
 
         # Build needed URIs based on the package's full URI.
         self._release_file_uri = self._getReleaseFileURI()
         self._release_gpg_uri = self._release_file_uri + '.gpg'
         self._packages_file_uri = os.path.join(os.path.dirname(self._uri), 'Packages')
 
-        # We need to make sure the directory for the the trusted.gpg
-        # file exists before starting to use GPG.
-        keyring_basedir = os.path.dirname(config.TRUSTED_KEYRING_FILE)
-        os.makedirs(keyring_basedir, exist_ok=True)
-        self._gpg = gnupg.GPG(keyring=config.TRUSTED_KEYRING_FILE)
-        self._gpg.encoding = 'utf-8'
+        # Paths as listed in the Release file (relative to the distribution's
+        # directory), and in the Packages file (relative to the archive root).
+        dist_base_uri = os.path.dirname(self._release_file_uri)
+        self._packages_file_path = self._packages_file_uri[len(dist_base_uri) + 1:]
+        self._package_filename = self._getPackageFilename()
+
+        # The GPG keyring is shared by all the validators in this process.
+        self._keyring = getTrustedKeyring()
+        self._packages_index = None
+        self._prepared = False
+
+    def prepare(self):
+        """
+        Fetch and verify the repository metadata needed to validate the package,
+        which can be done while the package itself is still being downloaded.
+
+        Return True if the metadata could be verified, or False otherwise.
+        """
+        if not self._prepared:
+            with stats.getDefault().timer('metadata'):
+                self._packages_index = self._getVerifiedPackagesIndex()
+                if self._mirrors is not None and self.getPackageEntry() is None:
+                    # Mirrors might not be in sync with each other or with the origin,
+                    # so the metadata could be inconsistent or not list the package.
+                    debugprint("Could not validate %s with metadata from mirrors, "
+                               "retrying from the origin" % self._package_filename)
+                    stats.getDefault().count('mirror_metadata_retries')
+                    self._mirrors = None
+                    self._packages_index = self._getVerifiedPackagesIndex(refresh=True)
+            self._prepared = True
+        return self._packages_index is not None
+
+    def matches(self, size, hashes):
+        """
+        Return True if a file with the given size and digests (a dictionary
+        indexed by hash name) is the package being validated, according to the
+        repository metadata, which must have been fetched with prepare() first.
+        """
+        return self._packages_index is not None and \
+               self._checkPackage(self._packages_index, size, hashes)
 
-    def run(self, localfile=None):
+    def getPackageEntry(self):
+        """
+        Return the entry of the package being validated in the Packages file, as
+        a dictionary with its size and digests, or None if not known (e.g. if
+        the repository metadata has not been fetched with prepare() first).
+        """
+        if self._packages_index is None:
+            return None
+        return aptindex.findEntry(self._packages_index, self._package_filename)
+
+    def run(self, localfile=None, hashes=None, size=None):
         """
         Run the checks required to validate the debian package, downloading the
         package from the URI specified in the constructor, unless an absolute path
         to an already present local file is provided via the localfile parameter.
 
+        If the digests of the local file are already known (e.g. because they were
+        computed while downloading it), they can be passed as a dictionary via the
+        hashes parameter, indexed by hash name, so that the file is not read again.
+        Its size can be passed as well via the size parameter, to be checked too.
+
         Return True if the debian package could be validated, or False otherwise.
         """
-        # If no local file has been specified, we download it from
-        # the URI provided and check if it's valid from there.
+        # If no local file has been specified, we download it from the URI
+        # provided, while fetching the metadata, and check it from there.
         with_localfile = localfile is not None
         if not with_localfile:
-            localfile = utils.downloadToTemporaryFile(self._uri)
+            download_future = self._fetchAsync(self._uri)
+            try:
+                self.prepare()
+            finally:
+                downloaded = download_future.result()
+            localfile = downloaded.path
+            hashes = downloaded.hashes
+            size = downloaded.size
+        elif hashes is None:
+            hashed = utils.hashFile(localfile)
+            hashes = hashed.hashes
+            size = hashed.size
 
-        release_file_path = utils.downloadToTemporaryFile(self._release_file_uri, self._temporary_dir)
-        release_gpg_path = utils.downloadToTemporaryFile(self._release_gpg_uri, self._temporary_dir)
-        packages_file_path = utils.downloadToTemporaryFile(self._packages_file_uri, self._temporary_dir)
+        try:
+            result = self.prepare()
+            with stats.getDefault().timer('validation'):
+                result = result and self._checkPackage(self._packages_index, size, hashes)
+        finally:
+            if not with_localfile:
+                os.remove(localfile)
 
-        self._importKeyIfNeeded(self._fingerprint)
-        verified = self._verifySignature(release_gpg_path, release_file_path)
+        return result
 
-        result = verified and \
-               self._findHashForFile(release_file_path, packages_file_path, hashlib.sha256) and \
-               self._findHashForFile(packages_file_path, localfile, hashlib.sha1)
+    def _getVerifiedPackagesIndex(self, refresh=False):
+        """
+        Return the parsed index of the Packages file for the package being
+        validated, taken from a Release file whose signature has been verified,
+        or None if the repository metadata could not be verified. If refresh is
+        True, the Release file is checked again even if the cache is fresh.
+
+        Repository metadata is cached per repository (and GPG key) for as long as
+        config.METADATA_CACHE_TTL seconds, or until the Release file changes, so
+        validating packages from the same repository does not require either
+        downloading or verifying the same metadata once and again. Packages not
+        found in the cached metadata make it be checked again once, though, as
+        they might have been published after it was last refreshed.
+        """
+        with _metadata_cache.lock(self._release_file_uri):
+            metadata = _metadata_cache.lookup(self._release_file_uri, self._fingerprint)
+            refresh = refresh or metadata is None or not metadata.isFresh()
+            prefetched = {}
+            try:
+                while True:
+                    if refresh:
+                        # Start downloading the preferred variant of the Packages file
+                        # along with the Release files if we don't have it already,
+                        # instead of waiting for the signature to be verified first.
+                        suffix = aptindex.PACKAGES_FILE_SUFFIXES[0]
+                        if suffix not in prefetched and \
+                           (metadata is None or metadata.getPackagesIndex(self._packages_file_uri) is None):
+                            prefetched[suffix] = self._fetchAsync(self._packages_file_uri + suffix)
+
+                        metadata = self._refreshReleaseFile(metadata)
+                        if metadata is None:
+                            return None
+
+                    packages_index = metadata.getPackagesIndex(self._packages_file_uri)
+                    if packages_index is None:
+                        packages_index = self._fetchPackagesIndex(metadata, prefetched)
+                        if packages_index is None:
+                            return None
+                        metadata.addPackagesIndex(self._packages_file_uri, packages_index)
+
+                    if refresh or aptindex.findEntry(packages_index, self._package_filename) is not None:
+                        break
+
+                    # The Release file is downloaded with a conditional request, so
+                    # this is cheap if the repository did not change in the meantime.
+                    debugprint("%s NOT found in the cached Packages file, checking for updates" %
+                               self._package_filename)
+                    stats.getDefault().count('metadata_revalidations')
+                    refresh = True
+            finally:
+                for future in prefetched.values():
+                    _discardDownload(future)
+
+            _metadata_cache.store(metadata)
+            return packages_index
+
+    def _fetchAsync(self, uri):
+        return utils.getDownloadExecutor().submit(downloadcache.getDefault().fetch,
+                                                  uri, self._temporary_dir,
+                                                  mirrors=self._mirrors)
+
+    def _fetchPackagesIndex(self, metadata, prefetched):
+        # Use the first variant of the Packages file listed in the Release
+        # file that can be downloaded, preferring the compressed ones.
+        release_index = metadata.getReleaseIndex()
+        for suffix in aptindex.PACKAGES_FILE_SUFFIXES:
+            release_entry = release_index.get(self._packages_file_path + suffix)
+            if release_entry is None:
+                continue
+
+            try:
+                if suffix in prefetched:
+                    packages_file = prefetched.pop(suffix).result()
+                else:
+                    packages_file = downloadcache.getDefault().fetch(self._packages_file_uri + suffix,
+                                                                     self._temporary_dir,
+                                                                     mirrors=self._mirrors)
+            except GLib.GError as e:
+                debugprint("Could not download Packages%s file: %s" % (suffix, repr(e)))
+                continue
+
+            # Keep the original extension, needed to know how to decompress it.
+            packages_file_path = packages_file.path + suffix
+            os.rename(packages_file.path, packages_file_path)
+            try:
+                # Packages files are only trusted if listed with their SHA256.
+                if not aptindex.matchesEntry(release_entry, packages_file.size,
+                                             packages_file.hashes, hash_names=['sha256']):
+                    debugprint("Packages%s file does NOT match its entry in the Release file" % suffix)
+                    return None
+
+                debugprint("Packages%s file matches its entry in the Release file" % suffix)
+                return aptindex.parsePackagesFile(packages_file_path)
+            finally:
+                os.remove(packages_file_path)
+
+        debugprint("No suitable Packages file for %s found in the Release file" % self._uri)
+        return None
+
+    def _checkPackage(self, packages_index, size, hashes):
+        entry = aptindex.findEntry(packages_index, self._package_filename)
+        if entry is None:
+            debugprint("%s NOT found in the Packages file" % self._package_filename)
+            return False
+
+        matches = aptindex.matchesEntry(entry, size, hashes)
+        debugprint("%s %smatches its entry in the Packages file" %
+                   (self._package_filename, ("" if matches else "does NOT ")))
+        return matches
+
+    def _refreshReleaseFile(self, metadata):
+        # Both files are downloaded at the same time, to save a round trip.
+        release_gpg_future = self._fetchAsync(self._release_gpg_uri)
+        try:
+            release_file = downloadcache.getDefault().fetch(self._release_file_uri,
+                                                            self._temporary_dir,
+                                                            mirrors=self._mirrors)
+        except GLib.GError:
+            _discardDownload(release_gpg_future)
+            raise
+
+        # Contents unchanged since its signature was last verified: we can
+        # skip verifying it again, and keep using the same Packages files.
+        if metadata is not None and metadata.release_sha256 == release_file.hashes['sha256']:
+            debugprint("Release file for %s not changed since last verified" %
+                       self._release_file_uri)
+            _discardDownload(release_gpg_future)
+            os.remove(release_file.path)
+            metadata.touch()
+            return metadata
 
-        os.remove(packages_file_path)
-        os.remove(release_gpg_path)
-        os.remove(release_file_path)
-        if not with_localfile:
-            os.remove(localfile)
+        try:
+            release_gpg_path = release_gpg_future.result().path
+        except GLib.GError:
+            os.remove(release_file.path)
+            raise
 
-        return result
+        try:
+            self._importKeyIfNeeded(self._fingerprint)
+            verified = self._verifySignature(release_gpg_path, release_file.path)
+        finally:
+            os.remove(release_gpg_path)
+
+        if not verified:
+            os.remove(release_file.path)
+            return None
+
+        return _metadata_cache.create(self._release_file_uri, self._fingerprint,
+                                      release_file.path, release_file.hashes['sha256'])
 
     def _getReleaseFileURI(self, suffix=None):
         try:
@@ -106,18 +317,24 @@ class PackageValidator:
 
         return os.path.join(self._uri[:dist_index], 'Release')
 
+    def _getPackageFilename(self):
+        try:
+            archive_root_index = self._uri.index('dists')
+        except ValueError:
+            return os.path.basename(self._uri)
+
+        # Packages files list the path of the packages relative to the
+        # root of the archive, which is what we use for the lookups.
+        return self._uri[archive_root_index:]
+
     def _importKeyIfNeeded(self, key):
-        keys = self._gpg.list_keys()
-        for fp in keys.fingerprints:
-            if fp == key:
-                debugprint("Key %s found in local keyring" % fp)
-                return
-        self._gpg.recv_keys(config.TRUSTED_KEY_SERVER, key)
+        if self._keyring.hasKey(key):
+            debugprint("Key %s found in local keyring" % key)
+            return
+        self._keyring.importKey(key)
 
     def _verifySignature(self, signature_path, signed_path):
-        signature_bfile = open(signature_path, 'rb')
-        verified = self._gpg.verify_file(signature_bfile, signed_path)
-        signature_bfile.close()
+        verified = self._keyring.verifyFile(signature_path, signed_path)
 
         if verified.trust_level is not None:
             debugprint("%s verified with signature %s" %
@@ -130,26 +347,235 @@ class PackageValidator:
                     os.path.basename(signature_path)))
         return False
 
-    def _findHashForFile(self, haystack_path, needle_path, hash_func):
-        needle_bfile = open(needle_path, 'rb')
-        needle_hash = hash_func(needle_bfile.read())
-        needle_hash_str = needle_hash.hexdigest()
-        needle_bfile.close()
-
-        debugprint("Hash %s for %s: %s" % (needle_hash.name, needle_path, needle_hash_str))
-
-        found = False
-        haystack_file = open(haystack_path, 'r')
-        for line in haystack_file:
-            if re.search(needle_hash_str, line):
-                found = True
-                break
-        haystack_file.close()
-
-        debugprint("%s hash %sfound in %s" % (os.path.basename(needle_path),
-                                              ("" if found else "NOT "),
-                                              os.path.basename(haystack_path)))
-        return found
+
+def _discardDownload(future):
+    """
+    Wait for the download tracked by future to finish, and remove its file.
+    """
+    try:
+        os.remove(future.result().path)
+    except (GLib.GError, OSError):
+        pass
+
+
+class TrustedKeyring:
+    """
+    Class wrapping the GPG keyring with the keys trusted to sign APT repositories,
+    which keeps the fingerprints of the keys in it cached in memory for as long
+    as the keyring file is not modified, to avoid spawning a gpg process just to
+    check whether a key is already present in the keyring.
+    """
+    def __init__(self, keyring_file=config.TRUSTED_KEYRING_FILE):
+        self._keyring_file = keyring_file
+        self._lock = threading.Lock()
+        self._fingerprints = None
+        self._fingerprints_mtime = None
+
+        # We need to make sure the directory for the the trusted.gpg
+        # file exists before starting to use GPG.
+        keyring_basedir = os.path.dirname(keyring_file)
+        os.makedirs(keyring_basedir, exist_ok=True)
+        self._gpg = gnupg.GPG(keyring=keyring_file)
+        self._gpg.encoding = 'utf-8'
+
+    def hasKey(self, fingerprint):
+        """
+        Return True if the key identified by fingerprint is in the keyring.
+        """
+        with self._lock:
+            mtime = self._getKeyringMTime()
+            if self._fingerprints is None or mtime != self._fingerprints_mtime:
+                debugprint("Loading fingerprints from %s" % self._keyring_file)
+                keys = self._gpg.list_keys()
+                self._fingerprints = set(self._normalize(fp) for fp in keys.fingerprints)
+                self._fingerprints_mtime = mtime
+            return self._normalize(fingerprint) in self._fingerprints
+
+    def importKey(self, fingerprint):
+        """
+        Import the key identified by fingerprint from the trusted key server.
+        """
+        with self._lock:
+            self._gpg.recv_keys(config.TRUSTED_KEY_SERVER, fingerprint)
+            self._fingerprints = None
+
+    def verifyFile(self, signature_path, signed_path):
+        """
+        Verify the detached signature in signature_path for the file in signed_path,
+        returning the gnupg.Verify object with the result of the verification.
+        """
+        with self._lock, stats.getDefault().timer('gpg_verify'):
+            with open(signature_path, 'rb') as signature_bfile:
+                return self._gpg.verify_file(signature_bfile, signed_path)
+
+    def _getKeyringMTime(self):
+        try:
+            return os.stat(self._keyring_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _normalize(self, fingerprint):
+        return fingerprint.replace(' ', '').upper()
+
+
+_trusted_keyring = None
+_trusted_keyring_lock = threading.Lock()
+
+def getTrustedKeyring():
+    """
+    Return the TrustedKeyring instance shared by the whole process.
+    """
+    global _trusted_keyring
+    with _trusted_keyring_lock:
+        if _trusted_keyring is None:
+            _trusted_keyring = TrustedKeyring()
+        return _trusted_keyring
+
+
+class RepositoryMetadata:
+    """
+    Class representing the verified metadata of an APT repository, stored
+    under a directory of the metadata cache: a Release file whose signature
+    has been verified, and the parsed indexes of those Packages files already
+    checked against it, saved in a compact binary form.
+    """
+    def __init__(self, cache_dir, release_uri, fingerprint, release_sha256,
+                 verified_time, packages=None, ttl=config.METADATA_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.release_uri = release_uri
+        self.fingerprint = fingerprint
+        self.release_sha256 = release_sha256
+        self.verified_time = verified_time
+        self.packages = packages or {}
+        self._ttl = ttl
+
+        # Indexes already loaded in memory, parsed or read from disk.
+        self._release_index = None
+        self._packages_indexes = {}
+
+    def isFresh(self):
+        age = time.time() - self.verified_time
+        return age >= 0 and age < self._ttl
+
+    def touch(self):
+        self.verified_time = time.time()
+
+    def getReleaseFilePath(self):
+        return os.path.join(self.cache_dir, 'Release')
+
+    def getReleaseIndex(self):
+        if self._release_index is None:
+            self._release_index = aptindex.parseReleaseFile(self.getReleaseFilePath())
+        return self._release_index
+
+    def getPackagesIndex(self, packages_uri):
+        if packages_uri in self._packages_indexes:
+            return self._packages_indexes[packages_uri]
+
+        name = self.packages.get(packages_uri)
+        if name is None:
+            return None
+
+        packages_index = aptindex.loadIndex(os.path.join(self.cache_dir, name))
+        if packages_index is not None:
+            self._packages_indexes[packages_uri] = packages_index
+        return packages_index
+
+    def addPackagesIndex(self, packages_uri, packages_index):
+        name = 'Packages-%s.index' % hashlib.sha1(packages_uri.encode('utf-8')).hexdigest()
+        aptindex.saveIndex(packages_index, os.path.join(self.cache_dir, name))
+        self.packages[packages_uri] = name
+        self._packages_indexes[packages_uri] = packages_index
+
+    def toDict(self):
+        return { 'release_uri': self.release_uri,
+                 'fingerprint': self.fingerprint,
+                 'release_sha256': self.release_sha256,
+                 'verified_time': self.verified_time,
+                 'packages': self.packages }
+
+
+class RepositoryMetadataCache:
+    """
+    Class keeping the verified metadata of APT repositories on disk, with one
+    subdirectory for every pair of repository root and GPG key fingerprint.
+    """
+    def __init__(self, cache_dir=config.METADATA_CACHE_DIR):
+        self._cache_dir = cache_dir
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+        # Entries already loaded, so that their indexes are kept in memory.
+        self._entries = {}
+
+    def lock(self, release_uri):
+        """
+        Return the lock serializing accesses to the metadata of a repository.
+        """
+        with self._locks_lock:
+            return self._locks.setdefault(release_uri, threading.Lock())
+
+    def lookup(self, release_uri, fingerprint):
+        """
+        Return the RepositoryMetadata cached for release_uri, verified with the
+        GPG key identified by fingerprint, or None if not present in the cache.
+        """
+        entry_dir = self._getEntryDir(release_uri, fingerprint)
+        if entry_dir in self._entries:
+            return self._entries[entry_dir]
+
+        try:
+            with open(os.path.join(entry_dir, 'metadata.json'), 'r') as metadata_file:
+                data = json.load(metadata_file)
+        except (OSError, ValueError):
+            return None
+
+        metadata = RepositoryMetadata(entry_dir, **data)
+        if not os.path.exists(metadata.getReleaseFilePath()):
+            return None
+
+        debugprint("Found cached metadata for %s" % release_uri)
+        self._entries[entry_dir] = metadata
+        return metadata
+
+    def create(self, release_uri, fingerprint, release_file_path, release_sha256):
+        """
+        Create a new entry in the cache for a freshly verified Release file,
+        dropping any metadata previously cached for the same repository.
+        """
+        entry_dir = self._getEntryDir(release_uri, fingerprint)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.makedirs(entry_dir, exist_ok=True)
+        except OSError as e:
+            raise GLib.GError("Metadata cache directory could not be created: %s" % repr(e))
+
+        metadata = RepositoryMetadata(entry_dir, release_uri, fingerprint,
+                                      release_sha256, time.time())
+        shutil.move(release_file_path, metadata.getReleaseFilePath())
+        self._entries[entry_dir] = metadata
+        return metadata
+
+    def store(self, metadata):
+        """
+        Save the description of the cached metadata for a repository to disk.
+        """
+        path = os.path.join(metadata.cache_dir, 'metadata.json')
+        try:
+            with open(path + '.tmp', 'w') as metadata_file:
+                json.dump(metadata.toDict(), metadata_file)
+            os.rename(path + '.tmp', path)
+        except OSError as e:
+            debugprint("Could not save cached metadata for %s: %s" %
+                       (metadata.release_uri, repr(e)))
+
+    def _getEntryDir(self, release_uri, fingerprint):
+        key = "%s %s" % (release_uri, fingerprint)
+        return os.path.join(self._cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+# Shared by all the instances of PackageValidator in the same process.
+_metadata_cache = RepositoryMetadataCache()
 
 
 if __name__== "__main__":
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+#
+# ppdstore.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+import config
+import os
+import stat
+import threading
+
+from gi.repository import GLib
+
+from debug import *
+
+# Name of the directory, under config.DRIVERS_DIR, where the contents of the
+# PPD files are stored, so that it is in the same filesystem than the drivers.
+PPD_STORE_DIRNAME = '.eos-config-printer-ppds'
+
+
+class PPDStoreUsage:
+    """
+    Class describing the disk usage of the PPDStore: the number of different
+    PPD files stored and of deployed files sharing them, the number of bytes
+    used by the PPD files stored, and the bytes saved by not duplicating them.
+    """
+    def __init__(self):
+        self.stored_files = 0
+        self.linked_files = 0
+        self.stored_bytes = 0
+        self.saved_bytes = 0
+
+
+class PPDStore:
+    """
+    Class implementing a content-addressed store of PPD files, where the PPD
+    files extracted from every driver package are replaced with hard links to
+    a single copy of each different content (and permissions and modification
+    time), so identical PPD files shipped by several packages take disk space
+    (and page cache) only once.
+
+    The number of hard links of every stored file is its reference count, so
+    replacing or removing a deployed driver releases its references without
+    any further bookkeeping. Stored files not referenced by any deployed file
+    anymore are removed by collectGarbage().
+    """
+    def __init__(self, store_dir=None):
+        self._store_dir = store_dir or os.path.join(config.DRIVERS_DIR, PPD_STORE_DIRNAME)
+        self._lock = threading.Lock()
+
+    def deduplicate(self, paths):
+        """
+        Replace every file in paths, a dictionary mapping the absolute path of
+        PPD files to their SHA256 digest, with a hard link to the stored copy
+        of its contents, storing it first if not present yet. All the files must
+        be in the same filesystem than the store.
+
+        Return the number of files and bytes that were already stored.
+        """
+        try:
+            os.makedirs(self._store_dir, exist_ok=True)
+        except OSError as e:
+            raise GLib.GError("PPD store directory could not be created: %s" % repr(e))
+
+        linked_files = 0
+        linked_bytes = 0
+        with self._lock:
+            for (path, sha256) in paths.items():
+                try:
+                    st = os.lstat(path)
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+
+                    object_path = self._objectPath(st, sha256)
+                    if self._linkObject(object_path, path):
+                        linked_files += 1
+                        linked_bytes += st.st_size
+                except OSError as e:
+                    debugprint("Could not deduplicate %s: %s" % (path, repr(e)))
+
+        debugprint("Deduplicated %d PPD file(s) (%d bytes)" % (linked_files, linked_bytes))
+        return (linked_files, linked_bytes)
+
+    def collectGarbage(self):
+        """
+        Remove the stored files no longer referenced by any deployed file.
+        """
+        with self._lock:
+            for (object_path, st) in self._iterObjects():
+                if st.st_nlink > 1:
+                    continue
+                try:
+                    os.remove(object_path)
+                    debugprint("Removed unreferenced PPD file %s" % object_path)
+                except OSError:
+                    pass
+
+    def getUsage(self):
+        """
+        Return a PPDStoreUsage object describing the disk usage of the store.
+        """
+        usage = PPDStoreUsage()
+        with self._lock:
+            for (object_path, st) in self._iterObjects():
+                references = st.st_nlink - 1
+                usage.stored_files += 1
+                usage.linked_files += references
+                usage.stored_bytes += st.st_size
+                usage.saved_bytes += max(references - 1, 0) * st.st_size
+        return usage
+
+    def _linkObject(self, object_path, path):
+        # Returns True if path was replaced by a link to a stored file, or False if
+        # it became the stored file itself, as it was the first with its contents.
+        try:
+            os.link(path, object_path)
+            return False
+        except FileExistsError:
+            pass
+
+        if os.path.samefile(path, object_path):
+            return False
+
+        tmp_path = path + '.ppdstore-tmp'
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        os.link(object_path, tmp_path)
+        os.rename(tmp_path, path)
+        return True
+
+    def _iterObjects(self):
+        try:
+            names = os.listdir(self._store_dir)
+        except OSError:
+            return
+
+        for name in names:
+            object_path = os.path.join(self._store_dir, name)
+            try:
+                yield (object_path, os.lstat(object_path))
+            except OSError:
+                continue
+
+    def _objectPath(self, st, sha256):
+        # Hard links share their permissions and times, so these are part of the
+        # name, as extracting in delta mode only reuses files with the same ones.
+        return os.path.join(self._store_dir, '%s-%o-%d' % (sha256, stat.S_IMODE(st.st_mode),
+                                                           int(st.st_mtime)))
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+def getDefault():
+    """
+    Return the PPDStore instance shared by the whole service.
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = PPDStore()
+        return _default_store
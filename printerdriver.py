@@ -0,0 +1,511 @@
+#!/usr/bin/python3
+#
+# printerdriver.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import config
+import debextract
+import downloadcache
+import os
+import pkgstore
+import ppdstore
+import registry
+import shutil
+import stats
+import tempfile
+import threading
+import time
+import utils
+
+from gi.repository import GLib
+
+from debug import *
+
+# Name of the directory, under config.DRIVERS_DIR, where packages are
+# extracted before being moved to their definite location.
+STAGING_DIRNAME = '.eos-config-printer-staging'
+
+# Prefix of the names reserved for the service under config.DRIVERS_DIR (like
+# STAGING_DIRNAME or ppdstore.PPD_STORE_DIRNAME), never deployed from packages.
+RESERVED_NAME_PREFIX = '.eos-config-printer'
+
+# Locks serializing changes to each directory under config.DRIVERS_DIR.
+_destination_locks = {}
+_destination_locks_lock = threading.Lock()
+
+def _getDestinationLock(path):
+    with _destination_locks_lock:
+        return _destination_locks.setdefault(path, threading.Lock())
+
+
+class PrinterDriver:
+    """
+    General class representing a printer driver that can be installed
+    and which we can ask for a list of installed PPD files to.
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def install(self):
+        debugprint("Installing printer driver '%s'..." % self._name)
+
+    def getInstalledPPDFiles(self):
+        return []
+
+
+class PrinterDriverOpenPrinting(PrinterDriver):
+    """
+    Subclass of PrinterDriver, represents a type of driver that will be
+    retrieved from OpenPrinting.org, and which follows a certain structure.
+
+    In delta mode (the default), files that did not change from the version of
+    the driver already installed, if any, are reused instead of written again.
+
+    If a utils.ProgressMonitor is passed, the installation reports its progress
+    to it, and stops as soon as it gets cancelled, unless it is being deployed.
+    """
+    def __init__(self, args, delta=True, monitor=None):
+        super().__init__("OpenPrinting")
+
+        if not args or 'uri' not in args:
+            raise TypeError("Can't find the URI parameter in %s" % repr(args))
+        self._uri = args['uri']
+
+        self._fingerprint = None
+        if 'fingerprint' in args:
+            self._fingerprint = args['fingerprint']
+
+        # Mirrors of the archive, as a whitespace separated list of their roots,
+        # only used for this request, and only if the package gets validated.
+        self._mirrors = None
+        if self._fingerprint is not None:
+            self._mirrors = utils.getMirrorRegistry().getMirrorSet(self._uri,
+                                                                   args.get('mirrors', '').split())
+
+        self._delta = delta
+        self._monitor = monitor or utils.ProgressMonitor()
+        self._installedPPDs = []
+        self._temporary_dir = None
+        self._staging_dir = None
+
+    def install(self):
+        """
+        Install a printer driver in the system by downloading it from
+        OpenPrinting.org, extracting its contents and making it available
+        to CUPS by placing it under a path reachable from /usr/share/ppd.
+        """
+        super().install()
+
+        statistics = stats.getDefault()
+        try:
+            with statistics.timer('install'):
+                self._ensureTemporaryDir()
+                self._doInstall()
+            statistics.count('installs')
+        except Exception as e:
+            statistics.count('installs_failed')
+            raise e
+        finally:
+            self._cleanupTemporaryFiles()
+            stats.exportStatistics()
+
+    def prefetch(self):
+        """
+        Download the driver package and validate it, if a fingerprint was provided,
+        keeping it in the package store so that installing it later on only needs
+        to extract and deploy it, without any network access.
+
+        Return the SHA256 digest of the package.
+        """
+        debugprint("Prefetching printer driver '%s'..." % self._name)
+
+        statistics = stats.getDefault()
+        try:
+            with statistics.timer('prefetch'):
+                self._ensureTemporaryDir()
+                downloaded = self._downloadAndValidate(self._createValidator())
+                package = pkgstore.getDefault().add(self._uri, self._fingerprint, downloaded)
+            statistics.count('prefetches')
+        except Exception as e:
+            statistics.count('prefetches_failed')
+            raise e
+        finally:
+            self._cleanupTemporaryFiles()
+            stats.exportStatistics()
+
+        return package.hashes['sha256']
+
+    def _createValidator(self):
+        if self._fingerprint is None:
+            return None
+
+        # Only needed (and loaded) when validating against a repository.
+        import pkgvalidator
+        return pkgvalidator.PackageValidator(self._uri, self._fingerprint,
+                                             temporary_dir=self._temporary_dir,
+                                             mirrors=self._mirrors)
+
+    def _doInstall(self):
+        validator = self._createValidator()
+
+        # If this same package has been installed already and is still in place,
+        # there is nothing else to do. When a fingerprint is provided, we can tell
+        # without even downloading the package, from the repository metadata.
+        # The registry is only an optimization, so errors reading it (e.g. the
+        # database is locked or corrupted) are handled as if nothing was found.
+        try:
+            installed = registry.getDefault().lookup(self._uri)
+        except GLib.GError as e:
+            debugprint("Could not look up %s in the registry: %s" % (self._uri, repr(e)))
+            installed = None
+        if installed is not None and \
+           (installed.fingerprint != self._fingerprint or not installed.isIntact()):
+            installed = None
+
+        # Packages prefetched already have been validated when downloaded, so
+        # they can be installed right away, without checking the repository.
+        store = pkgstore.getDefault()
+        prefetched = store.lookup(self._uri, self._fingerprint)
+        if prefetched is not None:
+            debugprint("Using package from %s prefetched already" % self._uri)
+            stats.getDefault().count('installs_prefetched')
+            downloaded = store.retrieve(prefetched, self._temporary_dir)
+        elif installed is not None and validator is not None and \
+             validator.prepare() and validator.matches(installed.size, installed.hashes):
+            self._reuseInstalledDriver(installed)
+            return
+        else:
+            downloaded = self._downloadAndValidate(validator)
+        filepath = downloaded.path
+
+        if installed is not None and installed.hashes.get('sha256') == downloaded.hashes['sha256']:
+            self._reuseInstalledDriver(installed)
+            store.discard(self._uri, self._fingerprint)
+            return
+
+        # Now that the package has been downloaded and validated, extract it
+        # to a staging directory in the same filesystem than its final location
+        # and begin its installation, so that it can be deployed atomically.
+        self._monitor.setStage('extracting', downloaded.size)
+        extraction_dir = self._ensureStagingDir()
+        extraction = self._extractDriverPackage(filepath, extraction_dir)
+        try:
+            os.remove(filepath)
+        except OSError as e:
+            raise GLib.GError("Error removing file %s" % repr(e))
+
+        # For the purpose of this script, assume drivers from OpenPrinting will
+        # always be installed under '/opt' so bail out early if not the case.
+        extracted_opt_dir = os.path.join(extraction_dir, 'opt')
+        if extraction.skipped or os.path.islink(extracted_opt_dir) or \
+           not os.path.isdir(extracted_opt_dir):
+            raise GLib.GError("Driver packages not meant to be installed "
+                              "inside the /opt directory are not currently "
+                              "supported")
+
+        # Identical PPD files already deployed by other drivers are shared with
+        # them through hard links to the PPD store, instead of duplicated.
+        statistics = stats.getDefault()
+        ppd_digests = dict((os.path.join(extraction_dir, name), sha256)
+                           for (name, sha256) in extraction.ppd_digests.items())
+        with statistics.timer('ppd_deduplication'):
+            (dedup_files, dedup_bytes) = ppdstore.getDefault().deduplicate(ppd_digests)
+        statistics.count('ppds_deduplicated', dedup_files)
+        statistics.count('bytes_deduplicated', dedup_bytes)
+
+        # Move the driver into the desired location, and create symlinks pointing
+        # to the directories containing the PPD files (found while extracting the
+        # package) from the /var/lib/eos-config-printer/ppd  directory, so that
+        # CUPS can find them. Also, fill the self._installedPPDs list to report
+        # to the caller.
+        # This is the last chance to cancel the installation, as nothing gets
+        # changed in the system until this point. Other jobs installing into
+        # the same destinations wait for this one to finish, with locks always
+        # taken in the same order to avoid deadlocks.
+        self._monitor.setStage('deploying')
+        destinations = sorted(os.path.join(config.DRIVERS_DIR, path)
+                              for path in os.listdir(os.path.join(extraction_dir, 'opt')))
+        locks = [_getDestinationLock(path) for path in destinations]
+        with statistics.timer('deployment_wait'):
+            for lock in locks:
+                lock.acquire()
+        try:
+            with statistics.timer('deployment'):
+                moved_dirs = self._deployDriverDirectories(extraction_dir)
+            ppd_dirs = [self._getDeployedPath(path) for path in extraction.ppd_dirs]
+            debugprint("Found %d PPD file(s) in %d PPD directory(s)" %
+                       (len(extraction.ppd_files), len(ppd_dirs)))
+            symlinks = []
+            if ppd_dirs:
+                with statistics.timer('symlinks'):
+                    symlinks = self._createSymlinksForCUPS(ppd_dirs)
+            self._installedPPDs = [self._getDeployedPath(path) for path in extraction.ppd_files]
+
+            # Keep a record of the installation, to avoid repeating it later on.
+            # The driver is in place already, so failing to do it is not fatal.
+            recorded = False
+            try:
+                with statistics.timer('registry'):
+                    registry.getDefault().record(registry.InstalledDriver(self._uri, self._fingerprint,
+                                                                          downloaded.size, downloaded.hashes,
+                                                                          time.time(), moved_dirs, symlinks,
+                                                                          self._installedPPDs))
+                recorded = True
+            except GLib.GError as e:
+                debugprint("Could not record installation of %s: %s" % (self._uri, repr(e)))
+                statistics.count('registry_errors')
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        # PPD files from the versions replaced might not be referenced anymore.
+        ppdstore.getDefault().collectGarbage()
+
+        # Installed packages are not needed anymore, as the registry takes over.
+        if recorded:
+            store.discard(self._uri, self._fingerprint)
+
+    def _downloadAndValidate(self, validator):
+        """
+        Download the package and validate it with validator, unless None, returning
+        a DownloadedFile object for it, or raising a GLib.GError if not valid.
+        """
+        # Try to download the file pointed by the URI and validate it.
+        # If any of these operations fails an GLib.GError exception
+        # will be raised and handled by the run() function.
+        # The digests of the package are computed while downloading it, so
+        # that the validator does not need to read the whole file back. The
+        # download cache avoids downloading it again if it did not change.
+        self._monitor.setStage('downloading')
+        download_future = utils.getDownloadExecutor().submit(downloadcache.getDefault().fetch,
+                                                             self._uri, self._temporary_dir,
+                                                             self._monitor, mirrors=self._mirrors)
+
+        # If no GPG fingerpring is provided, the package is considered to
+        # be 'trusted' (e.g. client checked it does not contain binaries).
+        # Otherwise, fetch and verify the repository metadata while the
+        # package is still being downloaded, and check it once finished.
+        metadata_verified = True
+        try:
+            if validator is not None:
+                metadata_verified = validator.prepare()
+        finally:
+            downloaded = download_future.result()
+
+        if validator is None:
+            return downloaded
+
+        self._monitor.setStage('validating', downloaded.size)
+        if metadata_verified and (downloaded.resumed or self._mirrors is not None) and \
+           not validator.matches(downloaded.size, downloaded.hashes):
+            # Whatever was downloaded before being interrupted might not belong
+            # to this very same file, and mirrors might not be in sync with the
+            # metadata, so download it again from the origin, now that we know
+            # what to expect, as that might be what made the validation fail.
+            debugprint("Download of %s could not be validated, retrying" % self._uri)
+            os.remove(downloaded.path)
+            self._monitor.setStage('downloading')
+            downloaded = downloadcache.getDefault().fetch(self._uri, self._temporary_dir,
+                                                          self._monitor,
+                                                          expected=validator.getPackageEntry())
+            self._monitor.setStage('validating', downloaded.size)
+
+        if not metadata_verified or \
+           not validator.run(localfile=downloaded.path, hashes=downloaded.hashes,
+                             size=downloaded.size):
+            raise GLib.GError("The package file could not be validated")
+
+        return downloaded
+
+    def _reuseInstalledDriver(self, installed):
+        debugprint("Package from %s already installed, nothing to do" % self._uri)
+        stats.getDefault().count('installs_reused')
+        self._installedPPDs = list(installed.ppds)
+
+    @staticmethod
+    def cleanupLeftovers():
+        """
+        Remove leftovers from previous installation attempts, which must only be
+        done when no installation is in progress (e.g. when starting the service).
+        """
+        for basedir in [config.TEMPORARY_DIR, os.path.join(config.DRIVERS_DIR, STAGING_DIRNAME)]:
+            try:
+                dircontents = os.listdir(basedir)
+            except OSError:
+                continue
+
+            for path in dircontents:
+                abs_path = os.path.join(basedir, path)
+                shutil.rmtree(abs_path, ignore_errors=True)
+                debugprint("Removed leftover directory %s" % abs_path)
+
+        # Interrupted downloads are kept for a while, to be resumed.
+        utils.cleanupPartialDownloads()
+
+    def _ensureTemporaryDir(self):
+        # Every installation uses its own directory, so that it does not
+        # interfere with any other one being processed at the same time.
+        try:
+            os.makedirs(config.TEMPORARY_DIR, exist_ok=True)
+            self._temporary_dir = tempfile.mkdtemp(dir=config.TEMPORARY_DIR)
+            debugprint("Created temporary directory in %s" % self._temporary_dir)
+        except OSError as e:
+            self._temporary_dir = None
+            raise GLib.GError("Temporary directory could not be created: %s" % repr(e))
+
+    def _ensureStagingDir(self):
+        staging_basedir = os.path.join(config.DRIVERS_DIR, STAGING_DIRNAME)
+        try:
+            os.makedirs(staging_basedir, exist_ok=True)
+            self._staging_dir = tempfile.mkdtemp(dir=staging_basedir)
+            debugprint("Created staging directory in %s" % self._staging_dir)
+        except OSError as e:
+            self._staging_dir = None
+            raise GLib.GError("Staging directory could not be created: %s" % repr(e))
+
+        return self._staging_dir
+
+    def _cleanupTemporaryFiles(self):
+        if self._temporary_dir:
+            shutil.rmtree(self._temporary_dir, ignore_errors=True)
+            debugprint("Removed temporary directory from %s" % self._temporary_dir)
+        self._temporary_dir = None
+
+        if self._staging_dir:
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+            debugprint("Removed staging directory from %s" % self._staging_dir)
+        self._staging_dir = None
+
+    def getInstalledPPDFiles(self):
+        """
+        Return the list of installed PPD files for this driver, or an
+        empty list if no file has been installed.
+        """
+        return self._installedPPDs
+
+    def _extractDriverPackage(self, driver_path, dest_dir):
+        """
+        Extracts the content of a driver package (always a debian package for now),
+        pointed by driver_path, and places the result under dest_dir.
+
+        Only the contents under '/opt' are extracted. Returns a
+        debextract.ExtractionResult object, which includes the list of paths
+        from the package left out (so the caller can decide what to do), and
+        the PPD files found while extracting it.
+        """
+        # Packages are read in-process as a stream, instead of forking 'dpkg -x'.
+        # In delta mode, unchanged files are hard linked from the deployed tree.
+        reference_dirs = { 'opt': config.DRIVERS_DIR } if self._delta else None
+        extractor = debextract.DebExtractor(driver_path, dest_dir, prefixes=('opt',),
+                                            reference_dirs=reference_dirs,
+                                            monitor=self._monitor)
+        statistics = stats.getDefault()
+        with statistics.timer('extraction'):
+            result = extractor.extract()
+        statistics.count('files_written', result.written_files)
+        statistics.count('bytes_written', result.written_bytes)
+        statistics.count('files_linked', result.linked_files)
+        statistics.count('bytes_linked', result.linked_bytes)
+        debugprint("Extracted %d file(s) from %s, %d of them (%d bytes) unchanged" %
+                   (len(result.extracted), driver_path,
+                    result.linked_files, result.linked_bytes))
+        return result
+
+    def _getDeployedPath(self, path):
+        """
+        Return the final location of a path from the package, relative to '/'.
+        """
+        return os.path.join(config.DRIVERS_DIR, os.path.relpath(path, 'opt'))
+
+    def _deployDriverDirectories(self, extraction_dir):
+        """
+        Move all the directories related to one driver from extraction_dir into
+        their definite location, under '/opt'.
+
+        The extraction directory is expected to be in the same filesystem than
+        '/opt', so that every directory is moved by an atomic rename, exchanging
+        it with the previously installed version of the driver, if present.
+
+        Returns a list with the full path of the directories moved.
+        """
+        extracted_opt_dir = os.path.join(extraction_dir, 'opt')
+        try:
+            dircontents = os.listdir(extracted_opt_dir)
+        except OSError as e:
+            raise GLib.GError("Error listing contents of directory: %s" % repr(e))
+
+        # Deploying these would replace (and then remove) our own directories,
+        # and symbolic links would make us move their targets into place.
+        for path in dircontents:
+            if path.startswith(RESERVED_NAME_PREFIX):
+                raise GLib.GError("Driver package contains a reserved directory: /opt/%s" % path)
+            if os.path.islink(os.path.join(extracted_opt_dir, path)):
+                raise GLib.GError("Driver package contains a symbolic link: /opt/%s" % path)
+
+        moved_dirs = []
+        for path in dircontents:
+            debugprint("Driver package found: %s" % path)
+            src = os.path.join(extracted_opt_dir, path)
+            dest = os.path.join(config.DRIVERS_DIR, path)
+
+            try:
+                debugprint("Moving %s into %s..." % (src, dest))
+                utils.replacePath(src, dest)
+                moved_dirs.append(dest)
+
+            except OSError as e:
+                raise GLib.GError("Error moving the files from %s into %s: %s"
+                                                % (src, dest, repr(e)))
+
+            # After the exchange, src points to the old version, if any.
+            if os.path.lexists(src):
+                shutil.rmtree(src, ignore_errors=True)
+
+        return moved_dirs
+
+    def _createSymlinksForCUPS(self, ppd_dirs):
+        """
+        Creates a symlink to every path in ppd_dirs from a CUPS visible directory.
+
+        Returns a list with the full path of the symlinks created.
+        """
+        # First of all, ensure the CUPS visible directory is created.
+        os.makedirs(config.CUPS_VISIBLE_PPD_DIR, exist_ok=True)
+
+        symlinks = []
+
+        for path in ppd_dirs:
+            # Sanity check.
+            if not path.startswith(config.DRIVERS_DIR + os.sep):
+                continue
+
+            # First we need to create an unique name for the symlink, and we do
+            # that by ignoring the '/opt' preffix and replacing '/' with '_'.
+            symlink_name = os.path.relpath(path, config.DRIVERS_DIR).replace('/', '_')
+
+            symlink_path = os.path.join(config.CUPS_VISIBLE_PPD_DIR, symlink_name)
+            if os.path.exists(symlink_path):
+                os.unlink(symlink_path)
+
+            os.symlink(path, symlink_path)
+            debugprint("Symlink created: %s -> %s" % (symlink_path, path))
+            symlinks.append(symlink_path)
+
+        return symlinks
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+#
+# registry.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import config
+import json
+import os
+import sqlite3
+import threading
+
+from gi.repository import GLib
+
+from debug import *
+
+
+class InstalledDriver:
+    """
+    Class representing a driver package installed through this service, with
+    the digests of the package and everything that was deployed from it.
+    """
+    def __init__(self, uri, fingerprint, size, hashes, installed_time,
+                 dirs, symlinks, ppds):
+        self.uri = uri
+        self.fingerprint = fingerprint
+        self.size = size
+        self.hashes = hashes
+        self.installed_time = installed_time
+        self.dirs = dirs
+        self.symlinks = symlinks
+        self.ppds = ppds
+
+    def isIntact(self):
+        """
+        Return True if everything deployed from the package is still in place.
+        """
+        for path in self.dirs:
+            if not os.path.isdir(path):
+                return False
+        for path in self.symlinks:
+            if not os.path.islink(path):
+                return False
+        for path in self.ppds:
+            if not os.path.exists(path):
+                return False
+        return True
+
+
+class DriverRegistry:
+    """
+    Class keeping a durable record, in a SQLite database, of the driver
+    packages installed through this service, indexed by their URI.
+    """
+    def __init__(self, db_path=config.REGISTRY_FILE):
+        self._db_path = db_path
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def lookup(self, uri):
+        """
+        Return the InstalledDriver recorded for uri, or None if not found.
+        """
+        with self._lock:
+            with self._connect() as connection:
+                row = connection.execute('SELECT * FROM drivers WHERE uri = ?',
+                                         (uri,)).fetchone()
+        return self._rowToDriver(row) if row is not None else None
+
+    def listDrivers(self):
+        """
+        Return the list of InstalledDriver objects recorded, sorted by URI.
+        """
+        with self._lock:
+            with self._connect() as connection:
+                rows = connection.execute('SELECT * FROM drivers ORDER BY uri').fetchall()
+        return [self._rowToDriver(row) for row in rows]
+
+    def record(self, driver):
+        """
+        Record the InstalledDriver object passed, replacing the previous record
+        for the same URI and any other ones deployed in the same directories.
+        """
+        with self._lock:
+            with self._connect() as connection:
+                for row in connection.execute('SELECT uri, dirs FROM drivers').fetchall():
+                    if row[0] != driver.uri and set(json.loads(row[1])) & set(driver.dirs):
+                        debugprint("Driver from %s replaced by %s" % (row[0], driver.uri))
+                        connection.execute('DELETE FROM drivers WHERE uri = ?', (row[0],))
+
+                connection.execute('INSERT OR REPLACE INTO drivers VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (driver.uri, driver.fingerprint, driver.size,
+                                    json.dumps(driver.hashes), driver.installed_time,
+                                    json.dumps(driver.dirs), json.dumps(driver.symlinks),
+                                    json.dumps(driver.ppds)))
+        debugprint("Recorded installation of driver from %s" % driver.uri)
+
+    def _connect(self):
+        try:
+            if not self._initialized:
+                os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+            connection = sqlite3.connect(self._db_path, timeout=30)
+            if not self._initialized:
+                with connection:
+                    connection.execute('CREATE TABLE IF NOT EXISTS drivers ('
+                                       'uri TEXT PRIMARY KEY, fingerprint TEXT, size INTEGER, '
+                                       'hashes TEXT, installed_time REAL, dirs TEXT, '
+                                       'symlinks TEXT, ppds TEXT)')
+                self._initialized = True
+        except (OSError, sqlite3.Error) as e:
+            raise GLib.GError("Error opening the drivers registry: %s" % repr(e))
+
+        return _ClosingConnection(connection)
+
+    def _rowToDriver(self, row):
+        (uri, fingerprint, size, hashes, installed_time, dirs, symlinks, ppds) = row
+        return InstalledDriver(uri, fingerprint, size, json.loads(hashes), installed_time,
+                               json.loads(dirs), json.loads(symlinks), json.loads(ppds))
+
+
+class _ClosingConnection:
+    """
+    Context manager committing (or rolling back) a transaction on a SQLite
+    connection, and closing the connection afterwards.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __enter__(self):
+        return self._connection.__enter__()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self._connection.__exit__(exc_type, exc_value, tb)
+        finally:
+            self._connection.close()
+
+        if isinstance(exc_value, sqlite3.Error):
+            raise GLib.GError("Error accessing the drivers registry: %s" % repr(exc_value))
+        return False
+
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+def getDefault():
+    """
+    Return the DriverRegistry instance shared by the whole service.
+    """
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = DriverRegistry()
+        return _default_registry
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+#
+# scheduler.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import collections
+import config
+import stats
+import threading
+import time
+
+from gi.repository import GLib
+
+from debug import *
+
+
+class Job:
+    """
+    Class representing a unit of work run by the JobScheduler, along with its
+    state and, once finished, either its result or the error it raised.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+
+    def __init__(self, key, func):
+        self.key = key
+        self.state = Job.QUEUED
+        self.submitted_time = time.monotonic()
+        self.result = None
+        self.error = None
+        self._func = func
+        self._callbacks = []
+
+    def _run(self):
+        stats.getDefault().record('queued', time.monotonic() - self.submitted_time)
+        self.state = Job.RUNNING
+        try:
+            self.result = self._func()
+        except GLib.GError as e:
+            self.error = e
+        except Exception as e:
+            nonfatalException()
+            self.error = GLib.GError("Unexpected error: %s" % repr(e))
+        self.state = Job.FINISHED
+
+
+class JobScheduler:
+    """
+    Class running jobs in a fixed pool of max_workers threads, keeping up to
+    max_pending jobs waiting in a queue. Once the queue is full, new jobs are
+    rejected instead of accepted, so that bursts of requests can not exhaust
+    the resources of the system.
+
+    Jobs submitted with a key are coalesced with the job queued or running
+    for that same key, if any, so the work is done only once for all callers.
+
+    Several jobs can be submitted at once as a batch, which takes a single
+    place in the queue, no matter how many jobs it contains, and whose jobs
+    are run in order as workers become available.
+    """
+    def __init__(self, max_workers=config.MAX_WORKERS, max_pending=config.MAX_PENDING_JOBS):
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._jobs_by_key = {}
+        self._workers = []
+
+    def submit(self, func, callback, key=None):
+        """
+        Schedule func to be run in a worker thread, and callback to be called from
+        there once finished, receiving the Job object as its only parameter.
+
+        Return the Job object, or raise a GLib.GError if too many jobs are pending.
+        """
+        return self.submitBatch([(func, callback, key)])[0]
+
+    def submitBatch(self, items):
+        """
+        Schedule a list of (func, callback, key) tuples, as passed to submit(), as
+        a batch taking a single place in the queue, so that it is either accepted
+        or rejected as a whole.
+
+        Return the list of Job objects, or raise a GLib.GError if too many jobs
+        are pending.
+        """
+        with self._condition:
+            existing = [self._jobs_by_key.get(key) if key is not None else None
+                        for (func, callback, key) in items]
+            if None in existing and len(self._queue) >= self._max_pending:
+                raise GLib.GError("Too many pending requests, try again later")
+
+            jobs = []
+            new_jobs = []
+            for ((func, callback, key), job) in zip(items, existing):
+                if job is None:
+                    # The same key might be found twice in the batch.
+                    job = self._jobs_by_key.get(key) if key is not None else None
+                if job is not None:
+                    debugprint("Job for %s in progress already, waiting for it" % repr(key))
+                else:
+                    job = Job(key, func)
+                    if key is not None:
+                        self._jobs_by_key[key] = job
+                    new_jobs.append(job)
+                job._callbacks.append(callback)
+                jobs.append(job)
+
+            if len(new_jobs) == 1:
+                self._queue.append(new_jobs[0])
+            elif new_jobs:
+                self._queue.append(collections.deque(new_jobs))
+
+            for i in range(min(len(new_jobs), self._max_workers - len(self._workers))):
+                self._startWorker()
+            self._condition.notify(len(new_jobs))
+            return jobs
+
+    def _startWorker(self):
+        worker = threading.Thread(target=self._workerThreadFunc, daemon=True)
+        self._workers.append(worker)
+        worker.start()
+
+    def _workerThreadFunc(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                if isinstance(self._queue[0], Job):
+                    job = self._queue.popleft()
+                else:
+                    # Batches stay at the head of the queue until all their
+                    # jobs have been taken by the workers.
+                    job = self._queue[0].popleft()
+                    if not self._queue[0]:
+                        self._queue.popleft()
+
+            job._run()
+
+            # No more callers can attach to the job from this point on.
+            with self._condition:
+                if job.key is not None and self._jobs_by_key.get(job.key) is job:
+                    del self._jobs_by_key[job.key]
+                callbacks = job._callbacks
+                job._callbacks = []
+
+            for callback in callbacks:
+                try:
+                    callback(job)
+                except Exception:
+                    nonfatalException()
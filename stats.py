@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+#
+# stats.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import bisect
+import config
+import contextlib
+import os
+import threading
+import time
+
+from debug import *
+
+# Upper bounds, in seconds, of the buckets of the histograms of durations.
+HISTOGRAM_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+# Prefix used for the names of the metrics written in Prometheus format.
+PROMETHEUS_PREFIX = 'eos_config_printer'
+
+
+class Histogram:
+    """
+    Class accumulating the number and total duration of the occurrences of a
+    stage, and how many of them fall in each one of the HISTOGRAM_BUCKETS
+    (plus an additional one, for those taking longer than the last bucket).
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS, duration)] += 1
+
+
+class Statistics:
+    """
+    Class keeping cumulative statistics of the service since it was started:
+    histograms of the time spent in every stage of the installations, and
+    counters (e.g. bytes downloaded, files written), both indexed by name.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def record(self, stage, duration):
+        """
+        Record that stage took duration seconds.
+        """
+        with self._lock:
+            self._histograms.setdefault(stage, Histogram()).add(duration)
+        debugprint("Stage '%s' took %.3f seconds" % (stage, duration))
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Return a context manager recording the time spent inside it for stage,
+        whether the code inside it raises an exception or not.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - start)
+
+    def count(self, name, value=1):
+        """
+        Increase the counter name by value.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def getHistograms(self):
+        """
+        Return a dictionary mapping the name of every stage to a tuple with the
+        number of times it was recorded, the total time spent in it, in seconds,
+        and the (non cumulative) number of occurrences in each bucket.
+        """
+        with self._lock:
+            return dict((stage, (h.count, h.total, list(h.buckets)))
+                        for (stage, h) in self._histograms.items())
+
+    def getCounters(self):
+        """
+        Return a dictionary mapping the name of every counter to its value.
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def writePrometheusFile(self, path):
+        """
+        Write all the statistics to the file pointed by path, in the text format
+        read by the textfile collector of the Prometheus node exporter.
+        """
+        name = PROMETHEUS_PREFIX + '_stage_duration_seconds'
+        lines = ["# HELP %s Time spent in each stage of the installations." % name,
+                 "# TYPE %s histogram" % name]
+        for (stage, (count, total, buckets)) in sorted(self.getHistograms().items()):
+            cumulative = 0
+            for (bound, bucket) in zip(HISTOGRAM_BUCKETS + ['+Inf'], buckets):
+                cumulative += bucket
+                lines.append('%s_bucket{stage="%s",le="%s"} %d' % (name, stage, bound, cumulative))
+            lines.append('%s_sum{stage="%s"} %f' % (name, stage, total))
+            lines.append('%s_count{stage="%s"} %d' % (name, stage, count))
+
+        for (counter, value) in sorted(self.getCounters().items()):
+            name = '%s_%s_total' % (PROMETHEUS_PREFIX, counter)
+            lines.append("# TYPE %s counter" % name)
+            lines.append("%s %d" % (name, value))
+
+        # The collector could read the file at any time, so replace it atomically.
+        tmp_path = path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w') as prom_file:
+                prom_file.write('\n'.join(lines) + '\n')
+            os.rename(tmp_path, path)
+        except OSError as e:
+            debugprint("Could not write statistics to %s: %s" % (path, repr(e)))
+
+
+_default_statistics = Statistics()
+
+def getDefault():
+    """
+    Return the Statistics instance shared by the whole service.
+    """
+    return _default_statistics
+
+def exportStatistics():
+    """
+    Write the statistics of the service in Prometheus format, if enabled.
+    """
+    if config.PROMETHEUS_TEXTFILE_ENABLED:
+        _default_statistics.writePrometheusFile(config.PROMETHEUS_TEXTFILE)
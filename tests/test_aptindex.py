@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+#
+# tests/test_aptindex.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import gzip
+import lzma
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import aptindex
+
+from gi.repository import GLib
+
+
+SHA256 = 'a' * 64
+SHA1 = 'b' * 40
+MD5 = 'c' * 32
+
+RELEASE_FILE = '''Origin: OpenPrinting
+Label: OpenPrinting
+Suite: lsb3.2
+MD5Sum:
+ %(md5)s 1234 main/binary-amd64/Packages
+SHA1:
+ %(sha1)s 1234 main/binary-amd64/Packages
+SHA256:
+ %(sha256)s 1234 main/binary-amd64/Packages
+ %(sha256)s 567 main/binary-amd64/Packages.gz
+''' % { 'md5': MD5, 'sha1': SHA1, 'sha256': SHA256.upper() }
+
+PACKAGES_FILE = '''Package: driver-a
+Version: 1.0
+Filename: dists/lsb3.2/main/binary-amd64/driver-a_1.0_all.deb
+Size: 100
+MD5sum: %(md5)s
+SHA1: %(sha1)s
+SHA256: %(sha256)s
+Description: First driver
+ with a multiline description
+ Filename: not/a/real/field.deb
+
+Package: driver-b
+Filename: pool/main/d/driver-b_2.0_all.deb
+Size: unknown
+MD5sum: %(md5)s
+
+Package: no-filename
+Size: 10
+''' % { 'md5': MD5, 'sha1': SHA1, 'sha256': SHA256 }
+
+
+class ParseTest(unittest.TestCase):
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def _writeFile(self, name, contents, open_func=open):
+        path = os.path.join(self._work_dir, name)
+        with open_func(path, 'wt') as index_file:
+            index_file.write(contents)
+        return path
+
+    def testParsesReleaseFile(self):
+        index = aptindex.parseReleaseFile(self._writeFile('Release', RELEASE_FILE))
+        self.assertEqual(index['main/binary-amd64/Packages'],
+                         { 'size': 1234, 'md5': MD5, 'sha1': SHA1, 'sha256': SHA256 })
+        self.assertEqual(index['main/binary-amd64/Packages.gz'], { 'size': 567, 'sha256': SHA256 })
+
+    def testParsesPackagesFile(self):
+        index = aptindex.parsePackagesFile(self._writeFile('Packages', PACKAGES_FILE))
+        self.assertEqual(sorted(index), ['dists/lsb3.2/main/binary-amd64/driver-a_1.0_all.deb',
+                                         'pool/main/d/driver-b_2.0_all.deb'])
+        self.assertEqual(index['dists/lsb3.2/main/binary-amd64/driver-a_1.0_all.deb'],
+                         { 'size': 100, 'md5': MD5, 'sha1': SHA1, 'sha256': SHA256 })
+        self.assertEqual(index['pool/main/d/driver-b_2.0_all.deb'], { 'size': -1, 'md5': MD5 })
+
+    def testParsesCompressedPackagesFiles(self):
+        expected = aptindex.parsePackagesFile(self._writeFile('Packages', PACKAGES_FILE))
+        for (suffix, open_func) in [('.gz', gzip.open), ('.xz', lzma.open)]:
+            path = self._writeFile('Packages' + suffix, PACKAGES_FILE, open_func)
+            self.assertEqual(aptindex.parsePackagesFile(path), expected)
+
+    def testRejectsCorruptedPackagesFile(self):
+        path = os.path.join(self._work_dir, 'Packages.xz')
+        with open(path, 'wb') as index_file:
+            index_file.write(b'not really xz')
+        with self.assertRaises(GLib.GError):
+            aptindex.parsePackagesFile(path)
+
+
+class MatchesEntryTest(unittest.TestCase):
+    ENTRY = { 'size': 100, 'md5': MD5, 'sha1': SHA1, 'sha256': SHA256 }
+
+    def testMatchesStrongestHash(self):
+        self.assertTrue(aptindex.matchesEntry(self.ENTRY, 100, { 'sha256': SHA256, 'sha1': SHA1 }))
+        self.assertFalse(aptindex.matchesEntry(self.ENTRY, 100, { 'sha256': 'd' * 64, 'sha1': SHA1 }))
+
+    def testFallsBackToSHA1(self):
+        self.assertTrue(aptindex.matchesEntry(self.ENTRY, 100, { 'sha1': SHA1 }))
+        self.assertFalse(aptindex.matchesEntry(self.ENTRY, 100, { 'sha1': SHA1 },
+                                               hash_names=['sha256']))
+
+    def testNeverMatchesWithMD5Only(self):
+        self.assertFalse(aptindex.matchesEntry(self.ENTRY, 100, { 'md5': MD5 }))
+        self.assertFalse(aptindex.matchesEntry({ 'size': 100, 'md5': MD5 }, 100,
+                                               { 'md5': MD5, 'sha256': SHA256 }))
+
+    def testChecksSizeOnlyIfKnown(self):
+        self.assertFalse(aptindex.matchesEntry(self.ENTRY, 99, { 'sha256': SHA256 }))
+        self.assertTrue(aptindex.matchesEntry(self.ENTRY, None, { 'sha256': SHA256 }))
+        self.assertTrue(aptindex.matchesEntry({ 'size': -1, 'sha256': SHA256 }, 99,
+                                              { 'sha256': SHA256 }))
+
+
+class FindEntryTest(unittest.TestCase):
+    INDEX = { 'dists/lsb3.2/main/binary-amd64/driver_1.0_all.deb': { 'size': 1 },
+              'pool/other/driver_1.0_all.deb': { 'size': 2 } }
+
+    def testFindsExactFilename(self):
+        self.assertEqual(aptindex.findEntry(self.INDEX, 'pool/other/driver_1.0_all.deb'),
+                         { 'size': 2 })
+
+    def testDoesNotMatchOtherPathsWithSameBasename(self):
+        self.assertIsNone(aptindex.findEntry(self.INDEX, 'pool/main/driver_1.0_all.deb'))
+        self.assertIsNone(aptindex.findEntry(self.INDEX, 'driver_1.0_all.deb'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+#
+# tests/test_debextract.py
+#
+# Copyright (C) 2015 Endless Mobile, Inc.
+# Authors:
+#  Mario Sanchez Prada <mario@endlessm.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import debextract
+
+from gi.repository import GLib
+
+
+def _tarMember(name, type_=tarfile.REGTYPE, contents=b'', linkname=''):
+    info = tarfile.TarInfo(name)
+    info.type = type_
+    info.mode = 0o755 if type_ == tarfile.DIRTYPE else 0o644
+    info.linkname = linkname
+    info.size = len(contents) if type_ == tarfile.REGTYPE else 0
+    return (info, contents)
+
+
+def _buildDeb(path, members, control_members=()):
+    # A data tarball with the given members, plus what makes it a debian package.
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tarball:
+        for (info, contents) in members:
+            tarball.addfile(info, io.BytesIO(contents) if info.isreg() else None)
+
+    control = io.BytesIO()
+    with tarfile.open(fileobj=control, mode='w:gz') as tarball:
+        for (info, contents) in control_members:
+            tarball.addfile(info, io.BytesIO(contents))
+
+    with open(path, 'wb') as deb_file:
+        deb_file.write(debextract.AR_MAGIC)
+        for (name, contents) in [('debian-binary', b'2.0\n'),
+                                 ('control.tar.gz', control.getvalue()),
+                                 ('data.tar.gz', data.getvalue())]:
+            header = '%-16s%-12d%-6d%-6d%-8s%-10d`\n' % (name, 0, 0, 0, '100644', len(contents))
+            deb_file.write(header.encode('ascii'))
+            deb_file.write(contents)
+            if len(contents) % 2:
+                deb_file.write(b'\n')
+
+
+class DebExtractorTest(unittest.TestCase):
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+        self._deb_path = os.path.join(self._work_dir, 'driver.deb')
+        self._dest_dir = os.path.join(self._work_dir, 'dest')
+        self._outside_dir = os.path.join(self._work_dir, 'outside')
+        os.makedirs(self._outside_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def _extract(self, members):
+        _buildDeb(self._deb_path, members)
+        return debextract.DebExtractor(self._deb_path, self._dest_dir).extract()
+
+    def _assertRejected(self, members):
+        with self.assertRaises(GLib.GError):
+            self._extract(members)
+        self.assertEqual(os.listdir(self._outside_dir), [])
+
+    def testExtractsFilesAndFindsPPDs(self):
+        result = self._extract([_tarMember('./opt/vendor', tarfile.DIRTYPE),
+                                _tarMember('./opt/vendor/ppds/printer.ppd', contents=b'*PPD-Adobe'),
+                                _tarMember('./usr/share/doc/vendor/README', contents=b'readme')])
+        with open(os.path.join(self._dest_dir, 'opt/vendor/ppds/printer.ppd'), 'rb') as ppd_file:
+            self.assertEqual(ppd_file.read(), b'*PPD-Adobe')
+        self.assertEqual(result.ppd_files, ['opt/vendor/ppds/printer.ppd'])
+        self.assertEqual(result.ppd_dirs, ['opt/vendor/ppds'])
+        self.assertEqual(result.skipped, ['usr/share/doc/vendor/README'])
+
+    def testRejectsParentDirectoryComponents(self):
+        self._assertRejected([_tarMember('./opt/../../outside/evil', contents=b'evil')])
+
+    def testRejectsAbsolutePaths(self):
+        self._assertRejected([_tarMember(os.path.join(self._outside_dir, 'evil'), contents=b'evil')])
+
+    def testRejectsWritingThroughSymlinks(self):
+        self._assertRejected([_tarMember('./opt/vendor/link', tarfile.SYMTYPE,
+                                         linkname=self._outside_dir),
+                              _tarMember('./opt/vendor/link/evil', contents=b'evil')])
+
+    def testRejectsDirectoriesThroughSymlinks(self):
+        self._assertRejected([_tarMember('./opt/vendor/link', tarfile.SYMTYPE,
+                                         linkname='../../../outside'),
+                              _tarMember('./opt/vendor/link/subdir', tarfile.DIRTYPE)])
+
+    def testRejectsHardLinksOutsideDestination(self):
+        self._assertRejected([_tarMember('./opt/hardlink', tarfile.LNKTYPE,
+                                         linkname='../outside/evil')])
+
+    def testRejectsHardLinksThroughSymlinks(self):
+        with open(os.path.join(self._outside_dir, 'secret'), 'wb') as secret_file:
+            secret_file.write(b'secret')
+        with self.assertRaises(GLib.GError):
+            self._extract([_tarMember('./opt/vendor/link', tarfile.SYMTYPE,
+                                      linkname=self._outside_dir),
+                           _tarMember('./opt/hardlink', tarfile.LNKTYPE,
+                                      linkname='./opt/vendor/link/secret')])
+        self.assertFalse(os.path.exists(os.path.join(self._dest_dir, 'opt/hardlink')))
+
+    def testSkipsSymlinkedPrefix(self):
+        os.makedirs(os.path.join(self._outside_dir, 'important'))
+        result = self._extract([_tarMember('./opt', tarfile.SYMTYPE, linkname=self._outside_dir)])
+        self.assertFalse(os.path.lexists(os.path.join(self._dest_dir, 'opt')))
+        self.assertEqual(result.extracted, [])
+        self.assertEqual(os.listdir(self._outside_dir), ['important'])
+
+    def testSkipsSymlinksRightUnderPrefix(self):
+        result = self._extract([_tarMember('./opt/vendor', tarfile.SYMTYPE, linkname=self._outside_dir),
+                                _tarMember('./opt/other/link', tarfile.SYMTYPE, linkname='../vendor')])
+        self.assertFalse(os.path.lexists(os.path.join(self._dest_dir, 'opt/vendor')))
+        self.assertTrue(os.path.islink(os.path.join(self._dest_dir, 'opt/other/link')))
+        self.assertEqual(result.extracted, ['opt/other/link'])
+
+
+class DeltaExtractionTest(unittest.TestCase):
+    CONTENTS = b'*PPD-Adobe'
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+        self._deb_path = os.path.join(self._work_dir, 'driver.deb')
+        self._dest_dir = os.path.join(self._work_dir, 'dest')
+        self._reference_dir = os.path.join(self._work_dir, 'reference')
+        os.makedirs(self._reference_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def _writeReference(self, name, mtime):
+        path = os.path.join(self._reference_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as reference_file:
+            reference_file.write(self.CONTENTS)
+        os.chmod(path, 0o644)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def _extract(self, mtime, with_md5sums=True):
+        member = _tarMember('./opt/vendor/printer.ppd', contents=self.CONTENTS)
+        member[0].mtime = mtime
+        control_members = []
+        if with_md5sums:
+            md5sums = ('%s  opt/vendor/printer.ppd\n' % hashlib.md5(self.CONTENTS).hexdigest())
+            control_members.append(_tarMember('./md5sums', contents=md5sums.encode('ascii')))
+        _buildDeb(self._deb_path, [member], control_members)
+        extractor = debextract.DebExtractor(self._deb_path, self._dest_dir,
+                                            reference_dirs={ 'opt': self._reference_dir })
+        return extractor.extract()
+
+    def testLinksUnchangedFiles(self):
+        reference_path = self._writeReference('vendor/printer.ppd', 1000)
+        result = self._extract(1000)
+        self.assertEqual(result.linked_files, 1)
+        self.assertTrue(os.path.samefile(reference_path,
+                                         os.path.join(self._dest_dir, 'opt/vendor/printer.ppd')))
+
+    def testWritesFilesWithDifferentModificationTime(self):
+        self._writeReference('vendor/printer.ppd', 1000)
+        result = self._extract(2000)
+        self.assertEqual((result.linked_files, result.written_files), (0, 1))
+
+    def testWritesFilesWithoutMD5Sums(self):
+        self._writeReference('vendor/printer.ppd', 1000)
+        result = self._extract(1000, with_md5sums=False)
+        self.assertEqual((result.linked_files, result.written_files), (0, 1))
+
+    def testDoesNotFollowSymlinksInReference(self):
+        # A directory deployed as a symbolic link must not be used as reference.
+        self._writeReference('elsewhere/printer.ppd', 1000)
+        os.symlink('elsewhere', os.path.join(self._reference_dir, 'vendor'))
+        result = self._extract(1000)
+        self.assertEqual((result.linked_files, result.written_files), (0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
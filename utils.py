@@ -20,45 +20,1001 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import aptindex
+import concurrent.futures
 import config
+import ctypes
+import errno
+import hashlib
+import http.client
+import json
 import os
+import queue
+import shutil
+import socket
+import stats
 import tempfile
+import threading
+import time
+import urllib.parse
 import urllib.request
 
 from gi.repository import GLib
-from urllib.error import URLError
+from urllib.error import HTTPError, URLError
 
 from debug import *
 
+# Size of the chunks read from the network and written to disk at once
+# while downloading, so that big files are never fully held in memory.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
-def downloadToTemporaryFile(uri, dest_dir=config.TEMPORARY_DIR):
+# Maximum number of HTTP redirections followed for a single request
+MAX_REDIRECTIONS = 5
+
+# Minimum time, in seconds, between two reports of progress within
+# the same stage of an operation.
+PROGRESS_REPORT_INTERVAL = 0.2
+
+# Digests computed for every downloaded file, named after the hashlib
+# algorithm (which is also what APT repositories' index files use). MD5 is
+# left out, as it is never trusted to validate a file (see aptindex.py).
+HASH_ALGORITHMS = ['sha1', 'sha256']
+
+
+class DownloadedFile:
     """
-    Download a file from the given URI and stores it in a temporary file under @dest_dir.
+    Class representing a file stored in the local filesystem, along with its
+    size and the digests computed for its contents while writing it to disk.
+    """
+    def __init__(self, path, size, hashes, etag=None, last_modified=None, resumed=False):
+        self.path = path
+        self.size = size
+        self.hashes = hashes
 
-    Return the path of the temporary file being stored, or None otherwise.
+        # Validators sent by the server, useful for conditional requests.
+        self.etag = etag
+        self.last_modified = last_modified
+
+        # Whether part of the file comes from a previous, interrupted download.
+        self.resumed = resumed
+
+    def __repr__(self):
+        return "DownloadedFile(%s, %d bytes)" % (self.path, self.size)
+
+
+class _StreamHasher:
     """
-    debugprint("Downloading file from %s..." % uri)
+    Helper class to compute the size and digests of a stream of bytes
+    incrementally, one chunk at a time.
+    """
+    def __init__(self):
+        self.size = 0
+        self._hashes = [hashlib.new(name) for name in HASH_ALGORITHMS]
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        for hash_obj in self._hashes:
+            hash_obj.update(chunk)
+
+    def hexdigests(self):
+        return dict((h.name, h.hexdigest()) for h in self._hashes)
+
+
+class ProgressMonitor:
+    """
+    Class used to report the progress of a long operation, as the name of its
+    current stage and the number of bytes processed out of the total (or 0 if
+    not known), and to request the operation to be cancelled from another thread.
+
+    The callback, if passed, is called as callback(stage, bytes_done, bytes_total)
+    from the thread running the operation, at most every PROGRESS_REPORT_INTERVAL
+    seconds unless the stage changes.
+    """
+    def __init__(self, callback=None):
+        self._callback = callback
+        self._cancelled = threading.Event()
+        self._last_report = 0
+        self.stage = None
+        self.bytes_done = 0
+        self.bytes_total = 0
+
+    def setStage(self, stage, bytes_total=0):
+        """
+        Start a new stage, checking whether the operation has been cancelled.
+        """
+        self.checkCancelled()
+        self.stage = stage
+        self.bytes_done = 0
+        self.bytes_total = bytes_total
+        self._report(force=True)
+
+    def update(self, bytes_done, bytes_total=None):
+        """
+        Update the progress of the current stage, checking whether the
+        operation has been cancelled.
+        """
+        self.checkCancelled()
+        self.bytes_done = bytes_done
+        if bytes_total is not None:
+            self.bytes_total = bytes_total
+        self._report()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def isCancelled(self):
+        return self._cancelled.is_set()
+
+    def checkCancelled(self):
+        """
+        Raise a GLib.GError if the operation has been cancelled.
+        """
+        if self._cancelled.is_set():
+            raise GLib.GError("Operation cancelled")
+
+    def _report(self, force=False):
+        now = time.monotonic()
+        if self._callback is None or \
+           (not force and now - self._last_report < PROGRESS_REPORT_INTERVAL):
+            return
+        self._last_report = now
+        self._callback(self.stage, self.bytes_done, self.bytes_total)
+
+
+def _copyStream(src_obj, dest_obj, hasher, monitor=None, bytes_total=0):
+    while True:
+        if monitor is not None:
+            monitor.update(hasher.size, bytes_total)
+        chunk = src_obj.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        dest_obj.write(chunk)
+
+
+class _PooledResponse:
+    """
+    Wrapper around an http.client.HTTPResponse for a connection taken from a
+    ConnectionPool, which gives the connection back to the pool when closed.
+    """
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def close(self):
+        if self._connection is None:
+            return
+
+        # Connections can only be reused once the whole response has been
+        # read, and if the server did not ask for them to be closed. Responses
+        # cut short by the server are closed too, but with bytes left to read.
+        if not self._response.isclosed() and self._response.length == 0:
+            self._response.read()
+        complete = self._response.length is None or self._response.length == 0
+        reusable = self._response.isclosed() and complete and not self._response.will_close
+        if not reusable:
+            self._response.close()
+        self._pool._releaseConnection(self._key, self._connection, reusable)
+        self._connection = None
+
+
+class ConnectionPool:
+    """
+    Class keeping persistent (keep-alive) HTTP and HTTPS connections to every
+    host, so that downloading several files from the same server (e.g. the
+    metadata of an APT repository and a package) reuses the same connection,
+    instead of opening a new one (and doing a TLS handshake) for each file.
+
+    No more than max_per_host connections to the same host are used at once,
+    and requests over that limit wait for a connection to be available.
+    """
+    def __init__(self, max_per_host=config.MAX_CONNECTIONS_PER_HOST,
+                 timeout=config.DOWNLOAD_TIMEOUT, idle_timeout=config.KEEPALIVE_TIMEOUT):
+        self._max_per_host = max_per_host
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._idle_connections = {}
+
+    def request(self, uri, headers=None, accept_errors=False):
+        """
+        Send a GET request for uri over a pooled connection, following redirections.
+
+        Return a response object that must be closed once read, or raise a GLib.GError
+        if the request could not be completed or the server replied with an error,
+        unless accept_errors is True, in which case error replies are returned too.
+        """
+        for i in range(MAX_REDIRECTIONS + 1):
+            response = self._requestOnce(uri, headers)
+            if response.status not in (301, 302, 303, 307, 308):
+                break
+
+            location = response.headers.get('Location')
+            response.read()
+            response.close()
+            if not location:
+                raise GLib.GError("Error downloading file %s: redirection without location" % uri)
+            uri = urllib.parse.urljoin(uri, location)
+            debugprint("Redirected to %s" % uri)
+        else:
+            raise GLib.GError("Error downloading file %s: too many redirections" % uri)
+
+        if not accept_errors and _isErrorStatus(response.status, headers):
+            response.close()
+            raise GLib.GError("Error downloading file %s: HTTP %d %s" %
+                              (uri, response.status, response.reason))
+        return response
+
+    def _requestOnce(self, uri, headers):
+        parsed = urllib.parse.urlsplit(uri)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise GLib.GError("%s is not a recognized URI" % uri)
+
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+
+        self._getSemaphore(key).acquire()
+        try:
+            # A connection kept alive might have been closed by the server in
+            # the meantime, in which case we retry once with a new connection.
+            (connection, reused) = self._getConnection(key)
+            try:
+                connection.request('GET', path, headers=headers or {})
+                response = connection.getresponse()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                if not reused:
+                    raise
+                debugprint("Connection to %s lost, reconnecting..." % parsed.hostname)
+                (connection, reused) = self._newConnection(key), False
+                connection.request('GET', path, headers=headers or {})
+                response = connection.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            self._getSemaphore(key).release()
+            raise GLib.GError("Error downloading file %s: %s" % (uri, repr(e)))
+        except:
+            self._getSemaphore(key).release()
+            raise
+
+        return _PooledResponse(self, key, connection, response)
+
+    def _getSemaphore(self, key):
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(self._max_per_host)
+            return self._semaphores[key]
+
+    def _getConnection(self, key):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle_connections.get(key, [])
+            while idle:
+                (connection, idle_since) = idle.pop()
+                if now - idle_since < self._idle_timeout:
+                    return (connection, True)
+                connection.close()
+        return (self._newConnection(key), False)
+
+    def _newConnection(self, key):
+        (scheme, host, port) = key
+        debugprint("Opening new connection to %s://%s" % (scheme, host))
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self._timeout)
+        return http.client.HTTPConnection(host, port, timeout=self._timeout)
+
+    def _releaseConnection(self, key, connection, reusable):
+        if reusable:
+            with self._lock:
+                self._idle_connections.setdefault(key, []).append((connection, time.monotonic()))
+        else:
+            connection.close()
+        self._getSemaphore(key).release()
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+def getConnectionPool():
+    """
+    Return the ConnectionPool instance shared by the whole process.
+    """
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = ConnectionPool()
+        return _connection_pool
+
+
+def _isErrorStatus(status, headers):
+    # Requested ranges not satisfiable are handled by the caller.
+    return status >= 400 and not (status == 416 and headers and 'Range' in headers)
+
+
+def openURI(uri, headers=None, mirrors=None):
+    """
+    Open the given URI for reading, using pooled persistent connections for
+    HTTP and HTTPS URIs, unless a proxy has been configured for them. If a
+    MirrorSet is passed via mirrors, the URI is opened from the fastest root
+    of the archive available, falling back to the rest of them if it fails.
+
+    Return a file-like object with 'status' and 'headers' attributes, which
+    must be closed once read, or raise a GLib.GError if it could not be opened.
+    """
+    if mirrors is not None:
+        return mirrors.open(uri, headers)
+    return _openURI(uri, headers)
+
+
+def _openURI(uri, headers, accept_errors=False):
+    scheme = urllib.parse.urlsplit(uri).scheme
+    if scheme in ('http', 'https') and scheme not in urllib.request.getproxies():
+        return getConnectionPool().request(uri, headers, accept_errors)
+
     try:
-        url_obj = urllib.request.urlopen(uri)
-        content = url_obj.read()
-        url_obj.close()
+        request = urllib.request.Request(uri, headers=headers or {})
+        return urllib.request.urlopen(request, timeout=config.DOWNLOAD_TIMEOUT)
+    except HTTPError as e:
+        if accept_errors or not _isErrorStatus(e.code, headers):
+            return e
+        raise GLib.GError("Error downloading file %s: %s" % (uri, repr(e.reason)))
     except ValueError:
         raise GLib.GError("%s is not a recognized URI" % uri)
     except URLError as e:
         raise GLib.GError("Error downloading file %s: %s" % (uri, repr(e.reason)))
 
+
+def getDownloadKey(uri, mirrors=None):
+    """
+    Return the key identifying the file downloaded from uri in the caches, which
+    is different if it might be downloaded from mirrors, as those files are only
+    trusted once validated, so they must never be reused by requests not doing it.
+    """
+    return uri if mirrors is None else 'mirrors:' + uri
+
+
+def getArchiveRoot(uri):
+    """
+    Return the root of the archive the file pointed by uri belongs to, with a
+    trailing slash: the parent directory of 'dists' or 'pool' for files from
+    APT repositories, or the directory containing the file otherwise.
+    """
+    for name in ['/dists/', '/pool/']:
+        index = uri.find(name)
+        if index >= 0:
+            return uri[:index + 1]
+    return uri.rsplit('/', 1)[0] + '/'
+
+
+class MirrorSet:
+    """
+    Class representing an archive available from several roots (the origin
+    and its mirrors) sharing the same layout, so that any file from it can be
+    downloaded from any of them. Only to be used for files validated afterwards
+    (i.e. against a signed repository), so that the trust is anchored by the
+    signatures and digests checked, not by the server the files come from.
+
+    Roots are ranked by their latency, first estimated by probing them all in
+    parallel, and then measured as the time to get the reply to every request,
+    as kept by the MirrorRegistry. While the latency of the best root has not
+    been measured yet, the request is raced across the first
+    config.MIRROR_RACE_COUNT roots not failing, keeping the first reply.
+    Otherwise, roots are tried in order until one of them replies.
+
+    Roots failing to reply, or replying with server errors, are penalized and
+    make us fail over to the rest of them. Mirrors replying with client errors
+    (e.g. 404 Not Found, as they might not have synced the file yet) make us
+    fail over too, without penalizing them, and the origin is always the last
+    root tried after the first one, as its replies are the final answer.
+    """
+    def __init__(self, registry, origin, roots):
+        self.origin = origin
+        self._registry = registry
+        self._roots = [origin] + [root for root in roots if root != origin]
+
+    def open(self, uri, headers=None):
+        """
+        Open uri, which must be under the origin, from the best root available.
+        Return a file-like object like openURI, or raise a GLib.GError if it
+        could not be opened from any of the roots.
+        """
+        self._registry._probeIfNeeded(self._roots)
+        path = uri[len(self.origin):]
+        ranked = self._registry._rank(self._roots)
+
+        race_roots = []
+        if not self._registry._isMeasured(ranked[0]):
+            race_roots = [root for root in ranked
+                          if not self._registry._isFailing(root)][:config.MIRROR_RACE_COUNT]
+
+        error = None
+        if len(race_roots) > 1:
+            stats.getDefault().count('mirror_races')
+            try:
+                response = self._race(race_roots, path, headers)
+            except GLib.GError as e:
+                error = e
+            else:
+                return self._checkResponse(uri, response, headers)
+        else:
+            race_roots = []
+
+        fallback_roots = [root for root in ranked[1:] if root != self.origin]
+        if ranked[0] != self.origin:
+            fallback_roots.append(self.origin)
+        for root in [ranked[0]] + fallback_roots:
+            if root in race_roots:
+                continue
+            if error is not None:
+                debugprint("Failing over to %s" % root)
+                stats.getDefault().count('mirror_failovers')
+            try:
+                response = self._openFromRoot(root, path, headers)
+            except GLib.GError as e:
+                error = e
+                continue
+            return self._checkResponse(uri, response, headers)
+        raise error
+
+    def _checkResponse(self, uri, response, headers):
+        status = getattr(response, 'status', None)
+        if status is not None and _isErrorStatus(status, headers):
+            response.close()
+            raise GLib.GError("Error downloading file %s: HTTP %d %s" %
+                              (uri, status, response.reason))
+        return response
+
+    def _openFromRoot(self, root, path, headers):
+        # Client errors are only returned as replies when coming from the
+        # origin, while the rest of errors are raised.
+        start = time.monotonic()
+        try:
+            response = _openURI(root + path, headers, accept_errors=True)
+            status = getattr(response, 'status', None)
+            if status is not None and status >= 500:
+                response.close()
+                raise GLib.GError("Error downloading file %s: HTTP %d %s" %
+                                  (root + path, status, response.reason))
+        except GLib.GError as e:
+            debugprint("Could not open %s from %s: %s" % (path, root, repr(e)))
+            self._registry._recordFailure(root)
+            raise
+
+        self._registry._recordLatency(root, time.monotonic() - start, measured=True)
+        if root != self.origin and status is not None and _isErrorStatus(status, headers):
+            response.close()
+            debugprint("Could not open %s from %s: HTTP %d" % (path, root, status))
+            raise GLib.GError("Error downloading file %s: HTTP %d %s" %
+                              (root + path, status, response.reason))
+        return response
+
+    def _race(self, roots, path, headers):
+        debugprint("Racing request for %s across %s" % (path, ", ".join(roots)))
+        results = queue.Queue()
+        lock = threading.Lock()
+        decided = threading.Event()
+
+        def race_thread_func(root):
+            try:
+                response = self._openFromRoot(root, path, headers)
+            except GLib.GError as e:
+                results.put((None, e))
+                return
+
+            # Only the first reply is used, and the later ones discarded.
+            with lock:
+                winner = not decided.is_set()
+                decided.set()
+            if winner:
+                debugprint("Using %s for %s" % (root, path))
+                results.put((response, None))
+            else:
+                response.close()
+
+        for root in roots:
+            threading.Thread(target=race_thread_func, args=(root,), daemon=True).start()
+
+        error = None
+        for i in range(len(roots)):
+            (response, error) = results.get()
+            if response is not None:
+                return response
+        raise error
+
+
+class MirrorRegistry:
+    """
+    Class keeping the mirrors of every archive listed in config.MIRRORS, and
+    what is known about every root (origin or mirror) used so far: its latency,
+    whether it was measured or just estimated by probing it, and when it last
+    failed. That is shared by all the MirrorSet objects using the same roots.
+    """
+    def __init__(self, mirrors=config.MIRRORS):
+        self._lock = threading.Lock()
+        self._mirrors = dict((self._normalize(origin), [self._normalize(root) for root in roots])
+                             for (origin, roots) in mirrors.items())
+        self._latencies = {}
+        self._measured = set()
+        self._failures = {}
+        self._probed = set()
+
+    def getMirrorSet(self, uri, roots=()):
+        """
+        Return a MirrorSet for the archive uri belongs to, with the mirrors from
+        config.MIRRORS for it plus the roots passed, or None if there are none.
+        """
+        origin = getArchiveRoot(uri)
+        roots = self._mirrors.get(origin, []) + [self._normalize(root) for root in roots if root]
+        if not [root for root in roots if root != origin]:
+            return None
+        return MirrorSet(self, origin, roots)
+
+    def _normalize(self, root):
+        return root if root.endswith('/') else root + '/'
+
+    def _probeIfNeeded(self, roots):
+        with self._lock:
+            roots = [root for root in roots if root not in self._probed]
+            self._probed.update(roots)
+        if not roots:
+            return
+
+        threads = [threading.Thread(target=self._probe, args=(root,), daemon=True)
+                   for root in roots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _probe(self, root):
+        # The time needed to open a TCP connection is a good estimate of the
+        # round trip time, without even sending a request to the server.
+        parsed = urllib.parse.urlsplit(root)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        start = time.monotonic()
+        try:
+            socket.create_connection((parsed.hostname, port),
+                                     timeout=config.MIRROR_PROBE_TIMEOUT).close()
+        except (OSError, TypeError) as e:
+            debugprint("Could not probe %s: %s" % (root, repr(e)))
+            self._recordFailure(root)
+            return
+
+        latency = time.monotonic() - start
+        debugprint("Probed %s: %.3f seconds" % (root, latency))
+        self._recordLatency(root, latency)
+
+    def _recordLatency(self, root, latency, measured=False):
+        with self._lock:
+            previous = self._latencies.get(root)
+            if previous is not None and root in self._measured:
+                latency = (previous + latency) / 2
+            self._latencies[root] = latency
+            if measured:
+                self._measured.add(root)
+                self._failures.pop(root, None)
+
+    def _recordFailure(self, root):
+        with self._lock:
+            self._failures[root] = time.monotonic()
+
+    def _isMeasured(self, root):
+        with self._lock:
+            return root in self._measured
+
+    def _isFailing(self, root):
+        with self._lock:
+            return self._isFailingLocked(root, time.monotonic())
+
+    def _isFailingLocked(self, root, now):
+        failure_time = self._failures.get(root)
+        return failure_time is not None and now - failure_time < config.MIRROR_FAILURE_BACKOFF
+
+    def _rank(self, roots):
+        now = time.monotonic()
+        with self._lock:
+            # Probed latencies are only estimates, so measured ones go first.
+            def key(root):
+                return (self._isFailingLocked(root, now), root not in self._measured,
+                        self._latencies.get(root, float('inf')))
+            return sorted(roots, key=key)
+
+
+_mirror_registry = None
+_mirror_registry_lock = threading.Lock()
+
+def getMirrorRegistry():
+    """
+    Return the MirrorRegistry instance shared by the whole process.
+    """
+    global _mirror_registry
+    with _mirror_registry_lock:
+        if _mirror_registry is None:
+            _mirror_registry = MirrorRegistry()
+        return _mirror_registry
+
+
+class _PartialDownload:
+    """
+    Class representing the file kept under config.PARTIAL_DOWNLOADS_DIR while
+    downloading the file identified by key (see getDownloadKey), along with the
+    validators sent by the server for it, so that an interrupted download can
+    be resumed later on from where it stopped.
+    """
+    def __init__(self, key, partial_dir=config.PARTIAL_DOWNLOADS_DIR):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.key = key
+        self.path = os.path.join(partial_dir, name)
+        self._info_path = self.path + '.json'
+        self._partial_dir = partial_dir
+        self.etag = None
+        self.last_modified = None
+
+    def load(self):
+        """
+        Return the number of bytes already downloaded, or 0 if the download
+        can not be resumed (e.g. the server did not send any validator).
+        """
+        try:
+            with open(self._info_path, 'r') as info_file:
+                info = json.load(info_file)
+            size = os.path.getsize(self.path)
+        except (OSError, ValueError):
+            return 0
+
+        if info.get('key') != self.key:
+            return 0
+        self.etag = info.get('etag')
+        self.last_modified = info.get('last_modified')
+        return size if self.getIfRange() is not None else 0
+
+    def save(self, etag, last_modified):
+        self.etag = etag
+        self.last_modified = last_modified
+        try:
+            os.makedirs(self._partial_dir, exist_ok=True)
+            with open(self._info_path + '.tmp', 'w') as info_file:
+                json.dump({ 'key': self.key, 'etag': etag, 'last_modified': last_modified },
+                          info_file)
+            os.rename(self._info_path + '.tmp', self._info_path)
+        except OSError as e:
+            debugprint("Could not save state of partial download: %s" % repr(e))
+
+    def getIfRange(self):
+        # Weak entity tags can not be used in If-Range headers.
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+    def open(self, offset):
+        os.makedirs(self._partial_dir, exist_ok=True)
+        file_obj = open(self.path, 'ab' if offset else 'wb')
+        file_obj.truncate(offset)
+        return file_obj
+
+    def remove(self):
+        for path in [self.path, self._info_path]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Locks making sure the same partial download is not written by two threads.
+_partial_locks = {}
+_partial_locks_lock = threading.Lock()
+
+def _getPartialLock(key):
+    with _partial_locks_lock:
+        return _partial_locks.setdefault(key, threading.Lock())
+
+
+def _hashPartialFile(path, size, hasher):
+    with open(path, 'rb') as file_obj:
+        while hasher.size < size:
+            chunk = file_obj.read(min(DOWNLOAD_CHUNK_SIZE, size - hasher.size))
+            if not chunk:
+                raise OSError(errno.EIO, "Partial download truncated", path)
+            hasher.update(chunk)
+
+
+def _parseContentRange(value):
+    # Of the form "bytes first-last/total", where total might be '*'.
     try:
-        (tmpfd, filepath) = tempfile.mkstemp(dir=dest_dir)
+        (unit, spec) = value.split(' ', 1)
+        (byte_range, total) = spec.split('/', 1)
+        first = int(byte_range.split('-', 1)[0])
+        total = int(total) if total.strip() != '*' else 0
+    except (AttributeError, ValueError):
+        return (None, 0)
+    return (first if unit == 'bytes' else None, total)
+
+
+def downloadFile(uri, dest_dir=config.TEMPORARY_DIR, headers=None, monitor=None, expected=None,
+                 mirrors=None):
+    """
+    Download a file from the given URI and stores it in a temporary file under @dest_dir,
+    copying it in fixed-size chunks and hashing its contents as they arrive.
+
+    Additional HTTP request headers can be passed via @headers, which allows
+    making conditional requests (e.g. using 'If-None-Match'). If a ProgressMonitor
+    is passed via @monitor, the progress is reported to it after every chunk, and
+    the download is stopped (raising a GLib.GError) as soon as it gets cancelled.
+
+    Files are written under config.PARTIAL_DOWNLOADS_DIR until complete, so that
+    if the download gets interrupted it is resumed by the next call for the same
+    URI, by means of a range request. If the size and digests of the file are
+    known (e.g. from the Packages file of an APT repository), they can be passed
+    as a dictionary via @expected, so that a resumed download not matching them
+    is started again from scratch.
+
+    If a MirrorSet is passed via @mirrors, the file might be downloaded from any
+    of the mirrors of its archive, so it must be validated before being used.
+
+    Return a DownloadedFile object with the path, size and digests of the new file,
+    or None if the server replied that the file has not been modified.
+    """
+    key = getDownloadKey(uri, mirrors)
+    partial_lock = _getPartialLock(key)
+    if not partial_lock.acquire(blocking=False):
+        # Already being downloaded by another thread, which owns the partial file.
+        debugprint("Partial download of %s in use, not resuming it" % uri)
+        return _downloadFile(uri, dest_dir, headers, monitor, None, expected, mirrors)
+
+    try:
+        return _downloadFile(uri, dest_dir, headers, monitor, _PartialDownload(key),
+                             expected, mirrors)
+    finally:
+        partial_lock.release()
+
+
+def _downloadFile(uri, dest_dir, headers, monitor, partial, expected, mirrors):
+    debugprint("Downloading file from %s..." % uri)
+    start = time.monotonic()
+
+    offset = partial.load() if partial is not None else 0
+    if offset and expected is not None and offset >= expected.get('size', -1) >= 0:
+        debugprint("Partial download of %s bigger than expected, discarding it" % uri)
+        offset = 0
+
+    request_headers = dict(headers or {})
+    if offset:
+        request_headers['Range'] = 'bytes=%d-' % offset
+        request_headers['If-Range'] = partial.getIfRange()
+
+    url_obj = openURI(uri, request_headers, mirrors)
+    status = getattr(url_obj, 'status', None)
+    if status == 304:
+        debugprint("File from %s has not been modified" % uri)
+        stats.getDefault().count('downloads_not_modified')
+        url_obj.close()
+        return None
+
+    if status == 416:
+        # What we have is not a prefix of the file anymore.
+        debugprint("Could not resume download of %s, starting over" % uri)
+        url_obj.close()
+        partial.remove()
+        return _downloadFile(uri, dest_dir, headers, monitor, partial, expected, mirrors)
+
+    try:
+        bytes_total = int(url_obj.headers.get('Content-Length', 0))
+    except ValueError:
+        bytes_total = 0
+
+    # If the file changed, or the server does not support ranges, we get
+    # the whole file instead (with a 200 status code) and start over.
+    resumed = False
+    if offset and status == 206:
+        (first, total) = _parseContentRange(url_obj.headers.get('Content-Range'))
+        if first != offset:
+            debugprint("Unexpected range received for %s, starting over" % uri)
+            url_obj.close()
+            partial.remove()
+            return _downloadFile(uri, dest_dir, headers, monitor, partial, expected, mirrors)
+        debugprint("Resuming download of %s from byte %d" % (uri, offset))
+        resumed = True
+        bytes_total = total
+    elif offset:
+        debugprint("Server sent the whole file %s, starting over" % uri)
+        offset = 0
+
+    etag = url_obj.headers.get('ETag')
+    last_modified = url_obj.headers.get('Last-Modified')
+    hasher = _StreamHasher()
+    try:
+        if partial is not None:
+            if resumed:
+                _hashPartialFile(partial.path, offset, hasher)
+            else:
+                partial.save(etag, last_modified)
+            file_obj = partial.open(offset)
+            filepath = partial.path
+        else:
+            (tmpfd, filepath) = tempfile.mkstemp(dir=dest_dir)
+            file_obj = os.fdopen(tmpfd, 'wb')
     except OSError as e:
+        url_obj.close()
+        if partial is not None:
+            partial.remove()
         raise GLib.GError("Temporary file could not be created: %s" % repr(e))
 
     debugprint("Storing file in %s..." % filepath)
     try:
-        file_obj = os.fdopen(tmpfd, 'wb')
-        file_obj.write(content)
-        file_obj.close()
+        with file_obj:
+            _copyStream(url_obj, file_obj, hasher, monitor, bytes_total)
+        # Connections closed early are only noticed by the missing bytes.
+        if bytes_total and hasher.size < bytes_total:
+            raise http.client.IncompleteRead(b'', bytes_total - hasher.size)
+    except (OSError, http.client.HTTPException, GLib.GError) as e:
+        # Keep what was downloaded so far, to resume it later on, if possible.
+        if partial is None:
+            os.remove(filepath)
+        elif partial.getIfRange() is None:
+            partial.remove()
+        else:
+            debugprint("Keeping %d bytes downloaded from %s" % (hasher.size, uri))
+        if isinstance(e, GLib.GError):
+            raise
+        raise GLib.GError("Error downloading file %s: %s" % (uri, repr(e)))
+    finally:
+        url_obj.close()
+
+    if resumed and expected is not None and \
+       not aptindex.matchesEntry(expected, hasher.size, hasher.hexdigests()):
+        debugprint("Resumed download of %s does not match, starting over" % uri)
+        partial.remove()
+        return _downloadFile(uri, dest_dir, headers, monitor, partial, expected, mirrors)
+
+    if partial is not None:
+        try:
+            (tmpfd, dest_path) = tempfile.mkstemp(dir=dest_dir)
+            os.close(tmpfd)
+            shutil.move(partial.path, dest_path)
+        except OSError as e:
+            partial.remove()
+            raise GLib.GError("Temporary file could not be created: %s" % repr(e))
+        partial.remove()
+        filepath = dest_path
+
+    stats.getDefault().record('download', time.monotonic() - start)
+    stats.getDefault().count('bytes_downloaded', hasher.size - offset)
+    stats.getDefault().count('files_downloaded')
+    if resumed:
+        stats.getDefault().count('downloads_resumed')
+        stats.getDefault().count('bytes_resumed', offset)
+
+    result = DownloadedFile(filepath, hasher.size, hasher.hexdigests(),
+                            etag=etag, last_modified=last_modified, resumed=resumed)
+    debugprint("Downloaded %d bytes from %s (SHA256: %s)" %
+               (result.size, uri, result.hashes['sha256']))
+    return result
+
+
+def cleanupPartialDownloads(max_age=config.PARTIAL_DOWNLOAD_MAX_AGE):
+    """
+    Remove the files of interrupted downloads not resumed for max_age seconds.
+    """
+    try:
+        names = os.listdir(config.PARTIAL_DOWNLOADS_DIR)
+    except OSError:
+        return
+
+    now = time.time()
+    for name in names:
+        path = os.path.join(config.PARTIAL_DOWNLOADS_DIR, name)
+        try:
+            if now - os.path.getmtime(path) >= max_age:
+                os.remove(path)
+                debugprint("Removed stale partial download %s" % path)
+        except OSError:
+            pass
+
+
+def downloadToTemporaryFile(uri, dest_dir=config.TEMPORARY_DIR):
+    """
+    Download a file from the given URI and stores it in a temporary file under @dest_dir.
+
+    Return the path of the temporary file being stored, or None otherwise.
+    """
+    return downloadFile(uri, dest_dir).path
+
+
+def hashFile(path):
+    """
+    Compute the size and digests of the local file pointed by @path, reading
+    it in fixed-size chunks instead of loading it fully into memory.
+
+    Return a DownloadedFile object describing the file.
+    """
+    hasher = _StreamHasher()
+    try:
+        with open(path, 'rb') as file_obj:
+            while True:
+                chunk = file_obj.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
     except OSError as e:
-        raise GLib.GError("File could not be opened: %s" % repr(e))
+        raise GLib.GError("File could not be read: %s" % repr(e))
+
+    return DownloadedFile(path, hasher.size, hasher.hexdigests())
+
+
+_download_executor = None
+_download_executor_lock = threading.Lock()
+
+def getDownloadExecutor():
+    """
+    Return the pool of threads shared by the whole process to download several
+    files at the same time, bounded to config.MAX_PARALLEL_DOWNLOADS threads.
+
+    Tasks submitted to this pool should never wait for other tasks in it.
+    """
+    global _download_executor
+    with _download_executor_lock:
+        if _download_executor is None:
+            _download_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.MAX_PARALLEL_DOWNLOADS)
+        return _download_executor
+
+
+# Flags for renameat2(), available in Linux since 3.15.
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = (1 << 1)
+
+_libc = None
+
+def _exchangePaths(path_a, path_b):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+
+    renameat2 = getattr(_libc, 'renameat2', None)
+    if renameat2 is None:
+        return False
+
+    result = renameat2(_AT_FDCWD, os.fsencode(path_a),
+                       _AT_FDCWD, os.fsencode(path_b), _RENAME_EXCHANGE)
+    if result == 0:
+        return True
+
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL):
+        # Not supported by the kernel or by the filesystem.
+        return False
+    raise OSError(err, os.strerror(err), path_a, None, path_b)
+
+
+def replacePath(src, dest):
+    """
+    Move the file or directory in @src to @dest, atomically replacing whatever
+    was in @dest, which must live in the same filesystem. When replacing, the
+    previous contents of @dest are left in @src, for the caller to remove.
+
+    If atomically exchanging both paths is not supported, the previous contents
+    of @dest are first moved out of the way, which leaves a small window where
+    nothing is present in @dest.
+    """
+    if not os.path.lexists(dest):
+        os.rename(src, dest)
+        return
 
-    return filepath
+    if _exchangePaths(src, dest):
+        return
 
+    debugprint("Atomic exchange not supported, falling back to two renames")
+    old_path = src + '.old'
+    os.rename(dest, old_path)
+    os.rename(src, dest)
+    os.rename(old_path, src)